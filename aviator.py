@@ -15,16 +15,25 @@
 #
 #####################################################
 
+import time
+startup_time = time.perf_counter() # start of the imports, reported by --profile-startup
 import argparse
-import config_matplotlibrc
+from array import array
 from datetime import datetime
+import functools
+import heapq
+import ipaddress
+import itertools
+import json
 import math
-import matplotlib
-import matplotlib.pyplot as plt
+import mmap
 import numpy as np
-from scapy.all import *
-from scapy.utils import rdpcap
-import time
+import os
+import socket
+import struct
+import sys
+import zipfile
+startup_imports = time.perf_counter() - startup_time # s
 
 # ======== variables - modify them as you wish =========
 date = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -41,16 +50,52 @@ numofbins = [25, 20, 15] # num of bins for hist plots. [15, 20, 10]
 # outputfiles-related
 outputfile_packets_extension = 'pcap'
 outputfile_statistics_extension = 'csv'
-outputfile_statistics_headernames = ['Packet Inter-arrival (ms)', 'Packet Length (bytes)', 'Data Rate (kbps)']
+outputfile_statistics_headernames = ['Packet Inter-arrival (ms)', 'Packet Length (bytes)'] # one row per packet
+outputfile_statistics_dtype = np.dtype([('interarrival_ms', '<f8'), ('length_bytes', '<i8')]) # columns of the binary format
+outputfile_datarate_headernames = ['Window Start (s)', 'Data Rate (kbps)'] # one row per window, saved to a separate file
+outputfile_datarate_dtype = np.dtype([('window_start_s', '<f8'), ('datarate_kbps', '<f8')])
+statistics_flush_rows = 10000 # statistics rows buffered before they are written to the file
+statistics_npy_header_size = 256 # bytes, multiple of 64 with room for any number of rows
+statistics_window = 1.0 # s, window of the data rate
+# fixed bins of the online statistics. Values beyond the last edge fall into the last bin, quantiles are accurate to one bin
+online_edges_datarate = np.r_[0, np.logspace(-3, 7, 2001)] # kbps, log-spaced bins above the bin of empty windows
+online_edges_interarrival = np.r_[0, np.logspace(-4, 6, 2001)] # ms, packets with the same timestamp fall into the first bin
+online_edges_length = np.arange(2**16) # bytes, one bin per length
 outputfolder = 'outputfiles'
+pcap_flush_packets = 1000 # packets buffered before they are written to the pcap file
+pcap_linktype = 228 # LINKTYPE_IPV4, raw IPv4 packets as scapy writes them
+pcap_snaplen = 65535
 
 # packet-related 
-ip_source = '10.0.0.201'
+ip_source = '10.0.0.201' # sends the downlink packets, receives the uplink packets
 ip_destination = '10.0.0.208'
+pkt_direction_downlink = 0
+pkt_direction_uplink = 1
+pkt_header_length = 28 # IPv4 (20 bytes) + UDP (8 bytes) headers
 pkt_length_maximum = 1486
 port_source = 47813 
 port_destination = 47814
 
+# clock-related
+time_processing_virtual = 0.0001 # host processing time (s) per packet emulated by the virtual clock
+
+# startup-related
+startup_budget = 0.5 # s, from the first import until the generation begins, checked by --profile-startup
+
+# instrumentation-related, --instrument. Functions of this module and methods as Class.method, timed on every call
+instrument_stages = {
+		'application': ['layer_application'],
+		'transport': ['layer_transport'],
+		'buffer': ['buffer_append', 'buffer_pop'], # slicing of the UDP buffer
+		'packet': ['pkt_create', 'pkt_scapy'],
+		'batch': ['generate_batch_downlink', 'generate_batch_uplink', 'generate_model'],
+		'statistics': ['statistics_results', 'ChannelStatistics.append'],
+		'io': ['PcapStreamWriter.append', 'PcapStreamWriter.extend', 'PcapStreamWriter.close', 'StatisticsWriter.append', 'save_packets'],
+		'send': ['UdpSender.send', 'AsyncUdpSender.send_block'],
+		'sleep': ['process_delay'],
+		'trace': ['trace_read'], # real traces of --empirical, --fit and --validate
+		'fit': ['model_fit_channel']}
+
 # ========================================
 # Frequencies of data generation. 
 # Each number corresponds to in how many  
@@ -68,17 +113,641 @@ frequency_batterystatus_camerastatus = 6
 frequency_imustatus_rotorstatus = 3
 frequency_video = 1
 
+# ========================================
+# Sizes of the generated parameters in bytes.
+# One of them is picked at random each time
+# the parameter is generated.
+# ========================================
+# downlink
+size_land_takeoff = [2**5, 2**6, 2**7]
+size_pitch_roll = [2**5 + 2**4, 2**5, 2**6]
+size_return_home = [2**5 + 2**4, 2**6 + 2**4, 2**6]
+size_throttle_yaw = [2**5, 2**5 + 2**4, 2**6]
+# uplink
+size_batterystatus = [2**5, 2**6]
+size_camerastatus = [2**5, 2**6]
+size_imustatus = [2**5, 2**6]
+size_rotorstatus = [2**5, 2**6]
+size_video = (3000, 1500) # mean and standard deviation of the normal distribution
+
+# batch engine
+batch_flushes_initial = 1024 # buffer flushes generated in the first vectorized chunk
+batch_flushes_maximum = 2**20 # upper bound of buffer flushes per vectorized chunk
+
+# parallel generation
+segment_packets = 100000 # packets per independently seeded segment. Output does not depend on the number of workers
+
+# fleet-related
+generator_chunk_packets = 100000 # packets taken from TrafficGenerator at once by the --batch, --model and target runs
+generator_flushes = 16384 # buffer flushes generated at once per channel by TrafficGenerator
+generator_model_packets = 65536 # packets sampled at once per channel by TrafficGenerator with a model
+fleet_flushes = 64 # buffer flushes generated at once per UAV channel, bounds the memory per UAV
+fleet_ip_first = '10.0.1.1' # address of the first UAV, the next UAVs count up from it. ip_source is the ground station
+fleet_merge_packets = 100000 # packets taken from the scheduler at once
+fleet_model_packets = 1024 # packets sampled at once per UAV channel with --model
+fleet_port_first = 50000 # ground station port of the first UAV, the next UAVs count up from it
+fleet_start_spread = 1.0 # s, each UAV starts at a random time within it
+
+# empirical sampler
+cachefolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache') # alias tables of --empirical, rebuilt when their source changes
+empirical_bins = 512 # log-spaced inter-arrival bins of the alias tables
+
+# model-related
+model_archive = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uav_datatraces.zip') # real traces the models are fitted to, found from any working directory
+model_components = 4 # log-normal components of the inter-arrival mixture
+model_fit_iterations = 200 # upper bound of EM iterations
+model_fit_tolerance = 1e-7 # EM stops when the mean log-likelihood improves less than this
+model_interarrival_minimum = 1e-6 # s, timestamp resolution of the traces. Packets with the same timestamp are this far apart
+model_lengths = 16 # most frequent packet lengths kept as exact values, the rest is a normal distribution
+model_parameter = 'f' # payload byte of the packets sampled from a fitted model
+model_std_minimum = 1e-3 # lower bound of the standard deviations, keeps the components from collapsing onto one value
+model_trace_suffix = '_modified' # removed from the trace names to name the models
+modelfolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+
+# trace-related
+trace_block_size = 2**20 # bytes of a trace parsed at once
+trace_linktypes = {1: (14, 12), 101: (0, None), 113: (16, 14), 228: (0, None)} # link layer: offset of the IP header, offset of the ethertype if any
+
+# validation-related
+validation_lags = 10 # autocorrelation lags compared
+validation_quantiles = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+# live sending
+send_async_packets = 64 # packets of the packet by packet generation queued before --send-async sends them as one block
+send_payload_maximum = 65507 # bytes, largest UDP payload over IPv4
+send_spin = 0.001 # s, the sender sleeps until this long before a deadline and busy-waits for the rest
+
+# ======== Channel statistics - feeds the packets of one channel to the statistics files and the online statistics in blocks, keeps no samples
+class ChannelStatistics:
+	def __init__(self, filename, binary, window):
+		extension = 'npy' if binary else outputfile_statistics_extension
+		self.datarate = OnlineStatistics(online_edges_datarate)
+		self.interarrival = OnlineStatistics(online_edges_interarrival)
+		self.length = OnlineStatistics(online_edges_length)
+		self.time_previous = None # s, last packet of the previous block
+		self.window = window # s
+		self.window_bytes, self.window_index = 0.0, None # window in progress, it can continue in the next block
+		self.window_skip = True # first window starts before the first packet
+		self.writer_datarate = StatisticsWriter(filename + '_datarate.' + extension, binary, outputfile_datarate_dtype, outputfile_datarate_headernames)
+		self.writer_packets = StatisticsWriter(filename + '.' + extension, binary, outputfile_statistics_dtype, outputfile_statistics_headernames)
+
+	def append(self, pkt_length, pkt_time): # block of packets in time order
+		pkt_length = np.asarray(pkt_length, dtype = np.int64)
+		pkt_time = np.asarray(pkt_time, dtype = np.float64)
+		if len(pkt_time) == 0: 
+			return
+		pkt_interarrival = np.diff(pkt_time, prepend = pkt_time[0] if self.time_previous is None else self.time_previous) * 1000 # multiply by 1000 to convert into ms
+		self.time_previous = pkt_time[-1]
+		window_index = np.floor(pkt_time / self.window).astype(np.int64)
+		if self.window_index is None: self.window_index = window_index[0]
+		window_bytes = np.bincount(window_index - self.window_index, weights = pkt_length) # empty windows count as 0 bytes
+		window_bytes[0] += self.window_bytes
+		window_start = (self.window_index + np.arange(len(window_bytes) - 1)) * self.window
+		datarate = window_bytes[:-1] * 8 / 1000 / self.window # multiply by 8 to convert bytes to bits, divide by 1000 to convert into kbps
+		self.window_bytes, self.window_index = window_bytes[-1], window_index[-1] # last window is not complete yet
+		if self.window_skip and len(datarate): 
+			datarate, window_start, self.window_skip = datarate[1:], window_start[1:], False
+		self.datarate.update(datarate)
+		self.interarrival.update(pkt_interarrival)
+		self.length.update(pkt_length)
+		for start in range(0, len(pkt_time), statistics_flush_rows): # rows are formatted in bounded blocks
+			self.writer_packets.append(pkt_interarrival[start:start + statistics_flush_rows], pkt_length[start:start + statistics_flush_rows])
+		self.writer_datarate.append(window_start, datarate)
+
+	def close(self):
+		self.writer_datarate.close()
+		self.writer_packets.close()
+
+	def summary(self, title):
+		print("\nSummary of %s (%d packets)" %(title, self.length.count))
+		for label, statistics in zip(label_x, [self.datarate, self.interarrival, self.length]):
+			if statistics.count:
+				print("%s: mean %.2f, standard deviation %.2f, median %.2f, 99th percentile %.2f" %(label, statistics.mean, statistics.std(), *statistics.quantile([0.5, 0.99])))
+
+# ======== Instrumentation - calls and time of each stage of a run, and the processing delays slept or simulated. Stages include the stages they call
+class Instrumentation:
+	def __init__(self, stages):
+		module = sys.modules[__name__]
+		self.calls = dict.fromkeys(stages, 0)
+		self.originals = [] # (owner, name, function) to remove the timers again
+		self.seconds = dict.fromkeys(stages, 0.0)
+		self.sleeps, self.slept = 0, 0.0 # processing delays and their total (s)
+		self.start = time.perf_counter()
+		for stage, functions in stages.items():
+			for function in functions:
+				owner, name = (getattr(module, function.split('.')[0]), function.split('.')[1]) if '.' in function else (module, function)
+				self.originals.append((owner, name, getattr(owner, name)))
+				setattr(owner, name, self.timer(getattr(owner, name), stage)) # calls look the function up at call time, so they reach the timer
+		self.originals.append((module, 'process_delay', module.process_delay))
+		module.process_delay = self.sleeper(module.process_delay)
+		self.originals.append((module, 'process_delays', module.process_delays))
+		module.process_delays = self.sleeper_batch(module.process_delays)
+
+	def dump(self, filename, dump_format, delays_tracked = True): # json or prometheus text format
+		if dump_format == 'json':
+			with open(filename + '.json', 'w') as dump_file:
+				json.dump({'seconds_total': time.perf_counter() - self.start, 'sleeps': self.sleeps if delays_tracked else None, 'slept_seconds': self.slept if delays_tracked else None,
+						'stages': {stage: {'calls': self.calls[stage], 'seconds': self.seconds[stage]} for stage in self.calls}}, dump_file, indent = 1)
+			return
+		lines = ['# HELP aviator_stage_calls_total Calls of the functions of each stage.', '# TYPE aviator_stage_calls_total counter']
+		lines += ['aviator_stage_calls_total{stage="%s"} %d' %(stage, calls) for stage, calls in self.calls.items()]
+		lines += ['# HELP aviator_stage_seconds_total Time spent in each stage, including the stages it calls.', '# TYPE aviator_stage_seconds_total counter']
+		lines += ['aviator_stage_seconds_total{stage="%s"} %.9f' %(stage, seconds) for stage, seconds in self.seconds.items()]
+		if delays_tracked:
+			lines += ['# HELP aviator_sleeps_total Processing delays of the generation.', '# TYPE aviator_sleeps_total counter', 'aviator_sleeps_total %d' %self.sleeps]
+			lines += ['# HELP aviator_slept_seconds_total Total of the processing delays, simulated with --virtual-clock.', '# TYPE aviator_slept_seconds_total counter', 'aviator_slept_seconds_total %.9f' %self.slept]
+		with open(filename + '.prom', 'w') as dump_file:
+			dump_file.write('\n'.join(lines) + '\n')
+
+	def remove(self):
+		for owner, name, function in reversed(self.originals):
+			setattr(owner, name, function)
+
+	def report(self, filename, dump_format, virtual_clock, delays_tracked = True): # end of the run: print the summary, dump it and remove the timers
+		self.summary(virtual_clock, delays_tracked)
+		self.dump(filename, dump_format, delays_tracked)
+		self.remove()
+
+	def sleeper(self, function): # counts the delays on top of the timer of the sleep stage
+		def delay(delay, time_virtual, virtual_clock):
+			self.sleeps += 1
+			self.slept += delay
+			return function(delay, time_virtual, virtual_clock)
+		return delay
+
+	def sleeper_batch(self, function): # same for the delay arrays of the batch engine
+		def delays(delay):
+			self.sleeps += int(np.count_nonzero(delay))
+			self.slept += float(np.sum(delay))
+			return function(delay)
+		return delays
+
+	def summary(self, virtual_clock, delays_tracked = True):
+		total = time.perf_counter() - self.start
+		print("\nInstrumentation (%.3f s, stages include the stages they call)" %total)
+		print("%-12s %12s %12s %8s" %('Stage', 'Calls', 'Time (s)', 'Share'))
+		for stage in self.calls:
+			if self.calls[stage]:
+				print("%-12s %12d %12.3f %7.1f%%" %(stage, self.calls[stage], self.seconds[stage], self.seconds[stage] / total * 100))
+		if not delays_tracked:
+			print("Processing delays: not tracked, they are drawn in the worker processes")
+		else:
+			print("Processing delays: %d, %.3f s %s" %(self.sleeps, self.slept, 'on the simulated clock' if virtual_clock else 'slept'))
+
+	def timer(self, function, stage):
+		def timed(*args, **kwargs):
+			start = time.perf_counter()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				self.calls[stage] += 1
+				self.seconds[stage] += time.perf_counter() - start
+		return timed
+
+# ======== Online statistics - running mean and variance (Welford), fixed-bin histogram and lag products of one metric in constant memory
+class OnlineStatistics:
+	def __init__(self, edges):
+		self.count = 0
+		self.counts = np.zeros(len(edges), dtype = np.int64) # values per bin
+		self.edges = edges
+		self.lag_count = np.zeros(validation_lags, dtype = np.int64)
+		self.lag_sum = np.zeros(validation_lags) # sums of the products of the values lags 1.. apart
+		self.mean, self.m2 = 0.0, 0.0 # mean and sum of the squared deviations
+		self.shift = None # first value, subtracted from the values of the lag products to keep them small
+		self.sums = np.zeros(len(edges)) # sum of the values per bin, their mean represents the bin
+		self.tail = np.zeros(0) # last validation_lags shifted values, paired with the next block
+
+	def autocorrelation(self): # lags 1..validation_lags, NaN without values
+		if self.count == 0: 
+			return np.full(validation_lags, np.nan)
+		variance = self.m2 / self.count if self.count else 0.0
+		if variance == 0: 
+			return np.zeros(validation_lags)
+		return (self.lag_sum / np.maximum(self.lag_count, 1) - (self.mean - self.shift)**2) / variance
+
+	def cdf(self, points): # share of the values up to each point, NaN without values
+		if self.count == 0: 
+			return np.full(np.shape(points), np.nan)
+		values, counts = self.histogram()
+		return np.r_[0, np.cumsum(counts)][np.searchsorted(values, points, side = 'right')] / max(self.count, 1)
+
+	def histogram(self): # value and count of the bins with values
+		filled = self.counts > 0
+		return self.sums[filled] / self.counts[filled], self.counts[filled]
+
+	def quantile(self, quantiles): # NaN without values
+		if self.count == 0: 
+			return np.full(np.shape(quantiles), np.nan)
+		values, counts = self.histogram()
+		return values[np.minimum(np.searchsorted(np.cumsum(counts), np.asarray(quantiles) * self.count), len(values) - 1)]
+
+	def std(self):
+		return math.sqrt(self.m2 / self.count) if self.count else 0.0
+
+	def update(self, values):
+		values = np.asarray(values, dtype = np.float64)
+		if len(values) == 0: 
+			return
+		count = self.count + len(values)
+		mean = values.mean()
+		delta = mean - self.mean
+		self.m2 += ((values - mean)**2).sum() + delta**2 * self.count * len(values) / count # block merged into the running state (Chan et al.)
+		self.mean += delta * len(values) / count
+		self.count = count
+		index = np.clip(np.searchsorted(self.edges, values, side = 'right') - 1, 0, len(self.edges) - 1)
+		self.counts += np.bincount(index, minlength = len(self.edges))
+		self.sums += np.bincount(index, weights = values, minlength = len(self.edges))
+		if self.shift is None: self.shift = values[0]
+		shifted = np.r_[self.tail, values - self.shift]
+		for lag in range(1, validation_lags + 1):
+			first = min(max(len(self.tail), lag), len(shifted)) # pairs that end in this block, none if fewer values than the lag
+			self.lag_sum[lag - 1] += np.dot(shifted[first:], shifted[first - lag:len(shifted) - lag])
+			self.lag_count[lag - 1] += len(shifted) - first
+		self.tail = shifted[-validation_lags:]
+
+# ======== Packet record - what the generator keeps of a packet. Payload bytes are only built for the pcap
+class PacketRecord:
+	__slots__ = ('direction', 'length', 'parameter', 'time', 'uav')
+
+	def __init__(self, direction, length, parameter, time, uav = 0):
+		self.direction = direction # pkt_direction_downlink or pkt_direction_uplink
+		self.length = length # bytes, including the IP & UDP headers
+		self.parameter = parameter # parameter the payload consists of
+		self.time = time # s
+		self.uav = uav # index of the UAV in the fleet
+
+	def __len__(self):
+		return self.length
+
+# ======== Packet list - packet records stored column-wise in compact arrays (16 bytes per packet)
+class PacketList:
+	__slots__ = ('direction', 'flows', 'length', 'parameter', 'time', 'uav')
+
+	def __init__(self, flows):
+		self.direction = array('B')
+		self.flows = flows # addresses and ports of each UAV, see flows_create
+		self.length = array('H')
+		self.parameter = array('B')
+		self.time = array('d')
+		self.uav = array('I')
+
+	def __iter__(self):
+		for direction, length, parameter, timestamp, uav in zip(self.direction, self.length, self.parameter, self.time, self.uav):
+			yield PacketRecord(direction, length, chr(parameter), timestamp, uav)
+
+	def __len__(self):
+		return len(self.time)
+
+	def append(self, pkt):
+		self.direction.append(pkt.direction)
+		self.length.append(pkt.length)
+		self.parameter.append(ord(pkt.parameter))
+		self.time.append(pkt.time)
+		self.uav.append(pkt.uav)
+
+	def extend(self, pkt_direction, pkt_length, pkt_parameter, pkt_time, pkt_uav = 0): # NumPy arrays of the batch engine
+		self.direction.frombytes(np.asarray(pkt_direction, dtype = np.uint8).tobytes())
+		self.length.frombytes(np.asarray(pkt_length, dtype = np.uint16).tobytes())
+		self.parameter.frombytes(np.asarray(pkt_parameter, dtype = np.uint8).tobytes())
+		self.time.frombytes(np.asarray(pkt_time, dtype = np.float64).tobytes())
+		self.uav.frombytes(np.broadcast_to(np.asarray(pkt_uav, dtype = np.uint32), np.shape(pkt_time)).tobytes())
+
+# ======== Pcap writer - streams packet records to a pcap file with struct-packed IPv4 & UDP headers
+class PcapStreamWriter:
+	def __init__(self, filename, flows):
+		self.chunk = []
+		self.file = open(filename, 'wb')
+		self.file.write(struct.pack('=IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, pcap_snaplen, pcap_linktype)) # global header
+		# same header fields as scapy: no options, id 1, ttl 64. Lengths and checksums are filled in per packet
+		self.header_ip = struct.Struct('!BBHHHBBH4s4s')
+		self.header_udp = struct.Struct('!HHHH')
+		self.header_record = struct.Struct('=IIII')
+		self.flows = {} # downlink is sent by the ground station to the UAV, uplink comes back
+		for uav, (ip_ground, ip_uav, port_ground, port_uav) in enumerate(flows):
+			self.flows[(uav, pkt_direction_downlink)] = self.flow(ip_ground, ip_uav, port_ground, port_uav)
+			self.flows[(uav, pkt_direction_uplink)] = self.flow(ip_uav, ip_ground, port_uav, port_ground)
+
+	def append(self, pkt):
+		self.chunk.append(self.pack(pkt.direction, pkt.length, ord(pkt.parameter), pkt.time, pkt.uav))
+		if len(self.chunk) >= pcap_flush_packets: self.flush()
+
+	def close(self):
+		self.flush()
+		self.file.close()
+
+	def extend(self, pkt_direction, pkt_length, pkt_parameter, pkt_time, pkt_uav = 0): # NumPy arrays of the batch engine
+		pkt_uav = np.broadcast_to(pkt_uav, np.shape(pkt_time))
+		for direction, length, parameter, timestamp, uav in zip(pkt_direction.tolist(), pkt_length.tolist(), pkt_parameter.tolist(), pkt_time.tolist(), pkt_uav.tolist()):
+			self.chunk.append(self.pack(direction, length, parameter, timestamp, uav))
+			if len(self.chunk) >= pcap_flush_packets: self.flush()
+
+	def flow(self, ip_flow_source, ip_flow_destination, port_flow_source, port_flow_destination): # header fields and constant checksum parts of one direction
+		address_source, address_destination = socket.inet_aton(ip_flow_source), socket.inet_aton(ip_flow_destination)
+		return (address_source, address_destination, port_flow_source, port_flow_destination,
+				checksum_sum(self.header_ip.pack(0x45, 0, 0, 1, 0, 64, 17, 0, address_source, address_destination)),
+				checksum_sum(address_source + address_destination) + 17 + port_flow_source + port_flow_destination) # pseudo-header without length
+
+	def flush(self): # write the buffered packets so that the file can be followed while it grows
+		self.file.write(b''.join(self.chunk))
+		self.file.flush()
+		self.chunk = []
+
+	def pack(self, direction, length, parameter, timestamp, uav):
+		address_source, address_destination, port_flow_source, port_flow_destination, sum_ip, sum_udp = self.flows[(uav, direction)]
+		length_payload = length - pkt_header_length
+		length_udp = length_payload + 8
+		checksum_ip = checksum_fold(sum_ip + length)
+		checksum_udp = checksum_fold(sum_udp + 2 * length_udp + 
+				(length_payload // 2) * parameter * 257 + (length_payload % 2) * (parameter << 8)) or 0xffff # payload is one repeated byte
+		seconds, microseconds = divmod(int(round(timestamp * 1000000)), 1000000) # a fraction that rounds up to 1000000 µs carries into the seconds
+		return b''.join((
+				self.header_record.pack(seconds, microseconds, length, length),
+				self.header_ip.pack(0x45, 0, length, 1, 0, 64, 17, checksum_ip, address_source, address_destination),
+				self.header_udp.pack(port_flow_source, port_flow_destination, length_udp, checksum_udp),
+				bytes((parameter,)) * length_payload))
+
+# ======== Statistics writer - streams the statistics rows to a csv or npy file in blocks
+class StatisticsWriter:
+	def __init__(self, filename, binary, dtype, headernames):
+		self.binary = binary
+		self.dtype = dtype # columns of the binary format
+		self.file = open(filename, 'wb' if binary else 'w')
+		self.row_format = ', '.join(['{}'] * len(headernames)) + '\n'
+		self.rows = 0 # rows written so far
+		if binary: # npy header is rewritten with the final number of rows on close
+			self.file.write(self.header(0))
+		else:
+			self.file.write(self.row_format.format(*headernames))
+
+	def append(self, *columns): # write a block of rows, one array per column
+		columns = [np.asarray(column) for column in columns]
+		if self.binary:
+			block = np.empty(len(columns[0]), dtype = self.dtype)
+			for name, column in zip(self.dtype.names, columns):
+				block[name] = column
+			self.file.write(block.tobytes())
+		else:
+			self.file.write(''.join(map(self.row_format.format, *(column.tolist() for column in columns))))
+		self.rows += len(columns[0])
+
+	def close(self):
+		if self.binary:
+			self.file.seek(0)
+			self.file.write(self.header(self.rows))
+		self.file.close()
+
+	def header(self, rows): # npy format version 1.0, padded with spaces to a fixed size so that it can be rewritten in place
+		header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" %(np.lib.format.dtype_to_descr(self.dtype), rows)
+		return b'\x93NUMPY\x01\x00' + struct.pack('<H', statistics_npy_header_size - 10) + header.ljust(statistics_npy_header_size - 11).encode('latin1') + b'\n'
+
+# ======== UDP sender - emits the packet records as UDP datagrams, paced by their timestamps on the monotonic clock
+class UdpSender:
+	def __init__(self, address, sink, speed):
+		self.address = address # (host, port) that receives all datagrams
+		self.bytes = 0
+		self.clock_first, self.clock_last = None, None # s, monotonic clock of the first and last send
+		self.jitter = 0.0 # sum of the squared inter-arrival errors (s^2)
+		self.lateness, self.lateness_maximum, self.lateness_previous = 0.0, 0.0, 0.0 # s, send time behind the deadline
+		self.packets = 0
+		self.payloads = {} # one payload per parameter, sent as slices without copying
+		self.sink = sink # packet list or pcap writer that the packets are passed on to
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.speed = speed # replay speed, 0 sends as fast as possible
+		self.time_first, self.time_last = None, None # s, timestamps of the first and last packet
+
+	def append(self, pkt):
+		self.send(pkt.length, ord(pkt.parameter), pkt.time)
+		self.sink.append(pkt)
+
+	def close(self):
+		self.socket.close()
+		print("\nSent %d packets (%d bytes) to %s:%d" %(self.packets, self.bytes, *self.address))
+		if self.packets < 2: 
+			return
+		duration = self.clock_last - self.clock_first
+		print("Inter-arrival (ms): achieved %.4f, target %s" %(duration / (self.packets - 1) * 1000, 
+				"%.4f" %((self.time_last - self.time_first) / self.speed / (self.packets - 1) * 1000) if self.speed else "as fast as possible"))
+		print("Achieved data rate: %.1f kbps" %(self.bytes * 8 / 1000 / duration if duration else float('inf')))
+		if self.speed:
+			print("Lateness (ms): mean %.4f, maximum %.4f. Inter-arrival jitter (ms): %.4f" %(self.lateness / self.packets * 1000, 
+					self.lateness_maximum * 1000, math.sqrt(self.jitter / (self.packets - 1)) * 1000))
+
+	def extend(self, pkt_direction, pkt_length, pkt_parameter, pkt_time, pkt_uav = 0): # NumPy arrays of the batch engine
+		for length, parameter, timestamp in zip(pkt_length.tolist(), pkt_parameter.tolist(), pkt_time.tolist()):
+			self.send(length, parameter, timestamp)
+		self.sink.extend(pkt_direction, pkt_length, pkt_parameter, pkt_time, pkt_uav)
+
+	def payload(self, length, parameter): # IP & UDP headers are added by the kernel
+		if parameter not in self.payloads: self.payloads[parameter] = memoryview(bytes((parameter,)) * send_payload_maximum)
+		return self.payloads[parameter][:length - pkt_header_length]
+
+	def send(self, length, parameter, timestamp):
+		if self.time_first is None:
+			self.time_first, self.clock_first = timestamp, time.perf_counter()
+		now = time.perf_counter()
+		lateness = 0.0
+		if self.speed:
+			deadline = self.clock_first + (timestamp - self.time_first) / self.speed # relative to the first packet, so late sends do not accumulate
+			if deadline - now > send_spin:
+				time.sleep(deadline - now - send_spin)
+			while now < deadline: # busy-wait the rest, sleep is not precise enough
+				now = time.perf_counter()
+			lateness = now - deadline # packets that are already due are sent back to back to catch up
+			if self.packets: self.jitter += (lateness - self.lateness_previous)**2
+			self.lateness_previous = lateness
+		self.socket.sendto(self.payload(length, parameter), self.address)
+		self.sent(length, lateness, now, timestamp)
+
+	def sent(self, length, lateness, now, timestamp): # account for one sent datagram
+		self.bytes += length
+		self.lateness += lateness
+		self.lateness_maximum = max(self.lateness_maximum, lateness)
+		self.packets += 1
+		self.clock_last = max(self.clock_last or now, now)
+		self.time_last = max(self.time_last or timestamp, timestamp)
+
+# ======== Asynchronous UDP sender - one coroutine and datagram transport per UAV flow, paced on a single event loop that is kept for the whole run
+class AsyncUdpSender(UdpSender):
+	def __init__(self, address, sink, speed):
+		super().__init__(address, sink, speed)
+		self.flows = {} # flow: (transport, lateness of its last packet), kept so that each flow keeps its source port
+		self.loop = None # created with the first block
+		self.pending = [] # packets of the packet by packet generation, sent in blocks of send_async_packets
+
+	def append(self, pkt):
+		self.pending.append((pkt.direction, pkt.length, ord(pkt.parameter), pkt.time, pkt.uav))
+		self.sink.append(pkt)
+		if len(self.pending) >= send_async_packets: 
+			self.send_pending()
+
+	def close(self):
+		self.send_pending()
+		for transport, lateness_previous in self.flows.values():
+			transport.close()
+		if self.loop is not None:
+			self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+			self.loop.close()
+		super().close()
+
+	def extend(self, pkt_direction, pkt_length, pkt_parameter, pkt_time, pkt_uav = 0): # NumPy arrays of the batch engine
+		self.send_block(pkt_direction, pkt_length, pkt_parameter, pkt_time, pkt_uav)
+		self.sink.extend(pkt_direction, pkt_length, pkt_parameter, pkt_time, pkt_uav)
+
+	async def flow(self, key, loop, flow_length, flow_parameter, flow_time): # packets of one flow in time order
+		import asyncio
+		transport, lateness_previous = self.flows[key]
+		for length, parameter, timestamp in zip(flow_length, flow_parameter, flow_time):
+			lateness = 0.0
+			if self.speed:
+				deadline = self.clock_first + (timestamp - self.time_first) / self.speed # relative to the first packet, so late sends do not accumulate
+				if deadline > loop.time():
+					await asyncio.sleep(deadline - loop.time()) # the other flows are served meanwhile
+				lateness = loop.time() - deadline
+				if lateness_previous is not None: self.jitter += (lateness - lateness_previous)**2
+				lateness_previous = lateness
+			else:
+				await asyncio.sleep(0) # let the other flows send
+			transport.sendto(self.payload(length, parameter))
+			self.sent(length, lateness, loop.time(), timestamp)
+		self.flows[key] = (transport, lateness_previous)
+
+	async def run(self, pkt_direction, pkt_length, pkt_parameter, pkt_time, pkt_uav):
+		import asyncio
+		loop = asyncio.get_running_loop()
+		if self.time_first is None:
+			self.time_first, self.clock_first = float(pkt_time[0]), loop.time()
+		flows = np.broadcast_to(pkt_uav, np.shape(pkt_time)).astype(np.int64) * 2 + pkt_direction # one flow per UAV and direction
+		order = np.argsort(flows, kind = 'stable') # keeps the time order within each flow
+		keys, first = np.unique(flows[order], return_index = True)
+		coroutines = []
+		for key, start, end in zip(keys.tolist(), first, np.r_[first[1:], len(order)]):
+			selected = order[start:end]
+			if key not in self.flows:
+				transport, protocol = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr = self.address) # own source port per flow
+				self.flows[key] = (transport, None)
+			coroutines.append(self.flow(key, loop, pkt_length[selected].tolist(), pkt_parameter[selected].tolist(), pkt_time[selected].tolist()))
+		await asyncio.gather(*coroutines)
+
+	def send_block(self, pkt_direction, pkt_length, pkt_parameter, pkt_time, pkt_uav):
+		import asyncio # only loaded for --send-async
+		if len(pkt_time) == 0: 
+			return
+		if self.loop is None: self.loop = asyncio.new_event_loop()
+		self.loop.run_until_complete(self.run(pkt_direction, pkt_length, pkt_parameter, pkt_time, pkt_uav))
+
+	def send_pending(self):
+		if self.pending:
+			self.send_block(*(np.array(column) for column in zip(*self.pending)))
+			self.pending = []
+
+# ======== Traffic generator - library API of the batch engine. Packets of one UAV are pulled on demand, one by one or as NumPy arrays, from one endless time-ordered stream
+# e.g. generator = TrafficGenerator('bidirectional', model = 'djispark', seed = 1); pkt_time, pkt_length, pkt_parameter, pkt_direction = generator.generate(10000)
+class TrafficGenerator:
+	def __init__(self, channel = 'downlink', empirical = None, model = None, seed = 0):
+		if channel not in ['bidirectional', 'downlink', 'uplink']:
+			raise ValueError("channel must be 'downlink', 'uplink' or 'bidirectional', not %r" %(channel,))
+		if empirical: model = empirical_load(empirical) # alias tables take the place of the fitted distributions
+		elif isinstance(model, str): model = model_load(model)
+		channels = [(downlink, direction) for downlink, direction in [(True, pkt_direction_downlink), (False, pkt_direction_uplink)] 
+				if channel in ['bidirectional', 'downlink' if downlink else 'uplink']]
+		for downlink, direction in channels:
+			if model: model_channel(model, downlink) # fails here rather than with the first packets
+		self.channels = [generate_chunks(downlink, generator_flushes, model, generator_model_packets, rng_create(seed, direction)) for downlink, direction in channels] # independent stream per channel
+		self.directions = [direction for downlink, direction in channels]
+		self.pending = [(np.zeros(0), np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.uint8))] * len(self.channels) # chunks not merged yet
+		self.position = 0 # first packet of ready not handed out yet
+		self.ready = (np.zeros(0), np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.uint8), np.zeros(0, dtype = np.uint8)) # time, length, parameter, direction
+		self.time_last = 0.0 # s, last packet handed out, --duration counts from it
+
+	def __iter__(self):
+		return self.iter_packets()
+
+	def block(self): # packets of all channels up to the earliest end of their chunks, in time order
+		for index, channel in enumerate(self.channels):
+			while len(self.pending[index][0]) == 0:
+				self.pending[index] = next(channel)
+		horizon = min(pending[0][-1] for pending in self.pending) # later packets may still be preceded by the next chunk of another channel
+		columns = []
+		for index, (pending, direction) in enumerate(zip(self.pending, self.directions)):
+			end = np.searchsorted(pending[0], horizon, side = 'right')
+			columns.append(tuple(column[:end] for column in pending) + (np.full(end, direction, dtype = np.uint8),))
+			self.pending[index] = tuple(column[end:] for column in pending)
+		pkt_time, pkt_length, pkt_parameter, pkt_direction = (np.concatenate(column) for column in zip(*columns))
+		order = np.argsort(pkt_time, kind = 'stable') # interleave the channels on the shared clock
+		return pkt_time[order], pkt_length[order], pkt_parameter[order], pkt_direction[order]
+
+	def fill(self, num_packets = None, time_end = None, target_bytes = None): # make packets ready until one of the targets is reached
+		blocks = [tuple(column[self.position:] for column in self.ready)]
+		count, length = len(blocks[0][0]), int(blocks[0][1].sum())
+		while not generate_reached(count, length, blocks[-1][0][-1] if count else 0.0, num_packets, time_end, target_bytes):
+			blocks.append(self.block())
+			count, length = count + len(blocks[-1][0]), length + int(blocks[-1][1].sum())
+		if len(blocks) > 1:
+			self.position, self.ready = 0, tuple(np.concatenate(column) for column in zip(*blocks))
+
+	def generate(self, num_packets = None, duration = None, target_bytes = None): # next packets as arrays until the first target: time (s), length (bytes), parameter (ASCII code), direction
+		if num_packets is None and duration is None and target_bytes is None:
+			raise ValueError("generate needs num_packets, duration or target_bytes")
+		time_end = None if duration is None else self.time_last + duration
+		self.fill(num_packets, time_end, target_bytes)
+		end = self.position + generate_end(self.ready[1][self.position:], self.ready[0][self.position:], num_packets, time_end, target_bytes)
+		packets = tuple(column[self.position:end] for column in self.ready)
+		self.position = end
+		if end: self.time_last = float(self.ready[0][end - 1])
+		return packets
+
+	def iter_packets(self, n = None): # next n packets as PacketRecord, endless without n
+		count = 0
+		while n is None or count < n:
+			if self.position == len(self.ready[0]): 
+				self.fill(1)
+			pkt_time, pkt_length, pkt_parameter, pkt_direction = (column[self.position] for column in self.ready)
+			self.position += 1
+			self.time_last = float(pkt_time)
+			count += 1
+			yield PacketRecord(int(pkt_direction), int(pkt_length), chr(pkt_parameter), float(pkt_time))
+
+# ======== Append a (parameter, length) record to the UDP buffer, merging it into the last record of the same parameter
+def buffer_append(buffer, record):
+	if buffer and buffer[-1][0] == record[0]:
+		buffer[-1] = (record[0], buffer[-1][1] + record[1])
+	else:
+		buffer.append(record)
+
+# ======== Remove the last length bytes from the UDP buffer and return them as records
+def buffer_pop(buffer, length):
+	payload = []
+	while length > 0 and buffer:
+		parameter, size = buffer.pop()
+		if size > length: # split the record, the rest stays in the buffer
+			buffer.append((parameter, size - length))
+			size = length
+		payload.append((parameter, size))
+		length -= size
+	payload.reverse()
+	return payload
+
+# ======== Internet checksum - fold a one's complement sum to 16 bits and invert it
+def checksum_fold(total):
+	while total >> 16:
+		total = (total & 0xffff) + (total >> 16)
+	return ~total & 0xffff
+
+# ======== Internet checksum - one's complement sum of the 16-bit words of data
+def checksum_sum(data):
+	return sum(struct.unpack('!%dH' %(len(data) // 2), data))
+
 # ======== Send downlink data to UDP buffer
 def data_to_buffer_downlink(buffer, i, land_takeoff, pitch_roll, return_home, throttle_yaw):
 	# add data to UDP buffer
 	if i % frequency_throttle_yaw == 0:
-		buffer += (throttle_yaw)
+		buffer_append(buffer, throttle_yaw)
 	if i % frequency_pitch_roll == 0:
-		buffer += (pitch_roll)
+		buffer_append(buffer, pitch_roll)
 	if i % frequency_land_takeoff == 0:
-		buffer += (land_takeoff)
+		buffer_append(buffer, land_takeoff)
 	if i % frequency_return_home == 0:
-		buffer += (return_home)
+		buffer_append(buffer, return_home)
 	return buffer
 
 # ======== Send uplink data to UDP buffer
@@ -86,41 +755,377 @@ def data_to_buffer_uplink(batterystatus, buffer, camerastatus,
 		i, imustatus, rotorstatus, video):
 	# add data to UDP buffer
 	if i % frequency_video == 0:
-		buffer += (video)
+		buffer_append(buffer, video)
 	if i % frequency_imustatus_rotorstatus == 0:
-		buffer += (rotorstatus)
-		buffer += (imustatus)
+		buffer_append(buffer, rotorstatus)
+		buffer_append(buffer, imustatus)
 	if i % frequency_batterystatus_camerastatus == 0:
-		buffer += (camerastatus)
-		buffer += (batterystatus)
+		buffer_append(buffer, camerastatus)
+		buffer_append(buffer, batterystatus)
 	return buffer
 
-# ======== Generate data for downlink channel
-def generate_data_downlink():
-	land_takeoff = 't' * np.random.choice([2**5, 2**6, 2**7])
-	pitch_roll = 'r' * np.random.choice([2**5 + 2**4, 2**5, 2**6])
-	return_home = 'h' * np.random.choice([2**5 + 2**4, 2**6 + 2**4, 2**6])
-	throttle_yaw =  'l' * np.random.choice([2**5, 2**5 + 2**4, 2**6])
+# ======== Batch engine - processing delays of layer_transport for the packets where eligible is set
+def delay_batch(delay_threshold, eligible, rng):
+	delay_probability = rng.uniform(0, 1, len(eligible))
+	time_sleep = process_delays(np.where(eligible & (delay_probability > delay_threshold), rng.exponential(0.2, len(eligible)) * 0.05, 0))
+	sleep_ul = process_delays(np.where(eligible & (delay_probability > 0.97), rng.exponential(1, len(eligible)) * 0.01 + 0.025, 0))
+	return time_sleep + sleep_ul
+
+# ======== Empirical sampler - alias tables of a device trace in the archive or of a statistics file of a previous run, cached on disk
+def empirical_load(source):
+	if os.path.isfile(source): # csv or npy statistics of a previous run, one channel
+		filename, member = source, None
+		name = os.path.splitext(os.path.basename(source))[0]
+	else: # pcap trace of a device in the archive
+		members = trace_members(model_archive)
+		if source not in members:
+			raise FileNotFoundError("There is no trace named %s.\nAvailable traces: %s. A csv or npy statistics file can be given as well." %(source, ', '.join(sorted(members))))
+		filename, member, name = model_archive, members[source], source
+	fingerprint = '%s:%s:%d:%d:%d:2' %(os.path.abspath(filename), member, os.path.getsize(filename), os.stat(filename).st_mtime_ns, empirical_bins)
+	cachefile = cachefolder + os.sep + name + '_empirical.npz'
+	if os.path.exists(cachefile):
+		with np.load(cachefile) as cache:
+			if str(cache['fingerprint']) == fingerprint:
+				return {channel: {key: cache[channel + '_' + key] for key in ['alias', 'bin', 'bin_count', 'bin_start', 'interarrival', 'length', 'probability']} 
+						for channel in ['downlink', 'uplink']}
+	print("Building the alias tables of %s..." %name)
+	if member is None:
+		if source.endswith('.npy'):
+			statistics = np.load(source)
+			pkt_interarrival, pkt_length = statistics['interarrival_ms'], statistics['length_bytes']
+		else:
+			pkt_interarrival, pkt_length = np.loadtxt(source, delimiter = ',', skiprows = 1, usecols = (0, 1), unpack = True, ndmin = 2) # arrays also for a single row
+		if len(pkt_interarrival) < 2:
+			raise ValueError("%s has fewer than two packets, an inter-arrival needs two." %source)
+		table = empirical_table(pkt_interarrival[1:] / 1000, pkt_length[1:].astype(np.int64)) # first packet has no inter-arrival
+		tables = {'downlink': table, 'uplink': table} # same table for both channels
+	else:
+		pkt_time, pkt_length, pkt_source, pkt_destination = trace_read(filename, member)
+		ip_ground, ip_uav, downlink, uplink = trace_channels(pkt_length, pkt_source, pkt_destination)
+		if downlink.sum() < 2 or uplink.sum() < 2:
+			raise ValueError("The trace %s has fewer than two packets in a direction, an inter-arrival needs two." %source)
+		tables = {channel: empirical_table(np.diff(pkt_time[selected]), pkt_length[selected][1:]) for channel, selected in [('downlink', downlink), ('uplink', uplink)]}
+	os.makedirs(cachefolder, exist_ok = True)
+	np.savez(cachefile, fingerprint = fingerprint, **{channel + '_' + key: value for channel, table in tables.items() for key, value in table.items()})
+	return tables
+
+# ======== Empirical sampler - alias table of the joint distribution of (inter-arrival bin, length) pairs, built with Vose's method
+def empirical_table(pkt_interarrival, pkt_length):
+	if len(pkt_interarrival) == 0:
+		raise ValueError("An alias table needs at least one inter-arrival, of two packets.")
+	pkt_interarrival = np.maximum(pkt_interarrival, model_interarrival_minimum)
+	interarrival_log = np.log(pkt_interarrival)
+	edges = np.linspace(interarrival_log.min(), interarrival_log.max() + model_std_minimum, empirical_bins + 1)
+	interarrival_bin = np.clip(np.searchsorted(edges, interarrival_log, side = 'right') - 1, 0, empirical_bins - 1)
+	order = np.argsort(interarrival_bin, kind = 'stable') # observed inter-arrivals grouped by bin
+	bin_count = np.bincount(interarrival_bin, minlength = empirical_bins)
+	pairs, count = np.unique(np.stack([interarrival_bin, pkt_length]), axis = 1, return_counts = True)
+	probability = count * len(count) / count.sum() # scaled so that the mean is 1
+	alias = np.zeros(len(count), dtype = np.int64)
+	small = list(np.flatnonzero(probability < 1))
+	large = list(np.flatnonzero(probability >= 1))
+	while small and large: # each column keeps its own probability and is topped up by one large entry
+		column, donor = small.pop(), large.pop()
+		alias[column] = donor
+		probability[donor] -= 1 - probability[column]
+		(small if probability[donor] < 1 else large).append(donor)
+	probability[small + large] = 1 # rounding leftovers
+	return {'alias': alias, 'bin': pairs[0], 'bin_count': bin_count, 'bin_start': np.r_[0, np.cumsum(bin_count)[:-1]], 
+			'interarrival': pkt_interarrival[order], 'length': pairs[1], 'probability': probability}
+
+# ======== Fleet - settings of each UAV from the defaults, overridden by the entries of the fleet configuration file
+def fleet_create(channel, fleet_config, num_uavs, seed):
+	overrides = []
+	if fleet_config:
+		try:
+			with open(fleet_config) as config_file:
+				overrides = json.load(config_file) # list of objects with any of the keys below, one per UAV
+		except (OSError, ValueError):
+			overrides = None
+		if not isinstance(overrides, list) or not all(isinstance(override, dict) for override in overrides):
+			print("Your input for --fleet-config is not valid.\nPlease provide a JSON file with a list of objects, one per UAV.")
+			sys.exit(0)
+	time_start = rng_create(seed).uniform(0, fleet_start_spread, num_uavs) # root stream, generation streams are spawned from the seed with keys
+	fleet = []
+	for uav in range(num_uavs):
+		settings = {
+				'channel': channel, # downlink, uplink or bidirectional
+				'ip': str(ipaddress.ip_address(fleet_ip_first) + uav),
+				'port': fleet_port_first + uav, # port of the ground station for this UAV
+				'start': float(time_start[uav]), # s
+				'time_scale': 1.0} # multiplies the packet times, > 1 slows the UAV down
+		if uav < len(overrides): settings.update(overrides[uav])
+		if settings['channel'] not in ['downlink', 'uplink', 'bidirectional']:
+			print("Channel of UAV %d in the fleet configuration is not valid.\nPlease provide downlink, uplink or bidirectional." %uav)
+			sys.exit(0)
+		if not isinstance(settings['port'], int) or isinstance(settings['port'], bool) or not 0 < settings['port'] < 65536:
+			print("Port of UAV %d in the fleet configuration is not valid.\nPlease provide an integer between 1 and 65535." %uav)
+			sys.exit(0)
+		try:
+			if not isinstance(settings['ip'], str): raise ValueError # IPv4Address also takes integers
+			ipaddress.IPv4Address(settings['ip'])
+		except ValueError:
+			print("IP of UAV %d in the fleet configuration is not valid.\nPlease provide an IPv4 address, e.g. %s." %(uav, fleet_ip_first))
+			sys.exit(0)
+		if not isinstance(settings['start'], (int, float)) or isinstance(settings['start'], bool) or not 0 <= settings['start'] < math.inf:
+			print("Start of UAV %d in the fleet configuration is not valid.\nPlease provide a non-negative number of seconds." %uav)
+			sys.exit(0)
+		if not isinstance(settings['time_scale'], (int, float)) or isinstance(settings['time_scale'], bool) or not 0 < settings['time_scale'] < math.inf:
+			print("Time scale of UAV %d in the fleet configuration is not valid.\nPlease provide a positive number." %uav)
+			sys.exit(0)
+		fleet.append(settings)
+	return fleet
+
+# ======== Addresses and ports of each UAV as (ip_ground, ip_uav, port_ground, port_uav). Without a fleet, the UAV is ip_destination
+def flows_create(fleet):
+	if not fleet:
+		return [(ip_source, ip_destination, port_source, port_destination)]
+	return [(ip_source, settings['ip'], settings['port'], port_destination) for settings in fleet]
+
+# ======== Batch engine - generate the whole trace with vectorized draws, stamped with the simulated clock
+def generate_batch(downlink, num_packets, rng):
+	pkt_time, pkt_length, pkt_parameter = [], [], []
+	count, flush, time_virtual = 0, 0, 0.0
+	flushes = batch_flushes_initial
+	while count < num_packets:
+		if downlink: 
+			chunk_time, chunk_length, chunk_parameter, time_virtual = generate_batch_downlink(flush, flush + flushes - 1, rng, time_virtual)
+		else:
+			chunk_time, chunk_length, chunk_parameter, time_virtual = generate_batch_uplink(flush, flush + flushes - 1, rng, time_virtual)
+		pkt_time.append(chunk_time)
+		pkt_length.append(chunk_length)
+		pkt_parameter.append(chunk_parameter)
+		count += len(chunk_time)
+		flush += flushes
+		flushes = min(max(int((num_packets - count) * flush / count * 1.05), 1), batch_flushes_maximum) # size the next chunk from the packets per flush so far
+		sys.stdout.write("Number of generated packets = %d out of %d   \r" %(min(count, num_packets), num_packets))
+		sys.stdout.flush()
+	return np.concatenate(pkt_time)[:num_packets], np.concatenate(pkt_length)[:num_packets], np.concatenate(pkt_parameter)[:num_packets]
+
+# ======== Batch engine - downlink packets of the buffer flushes flush_first..flush_last
+def generate_batch_downlink(flush_first, flush_last, rng, time_virtual):
+	i = np.arange(0 if flush_first == 0 else (flush_first - 1) * frequency_buffer + 1, flush_last * frequency_buffer + 1)
+	# parameters in the order of data_to_buffer_downlink
+	frequencies = np.array([frequency_throttle_yaw, frequency_pitch_roll, frequency_land_takeoff, frequency_return_home])
+	parameters = np.frombuffer(b'lrth', dtype = np.uint8)
+	sizes = [size_throttle_yaw, size_pitch_roll, size_land_takeoff, size_return_home]
+	field_iteration, field_parameter = np.nonzero(i[:, None] % frequencies == 0) # fields sent to the buffer, in buffer order
+	field_length = np.empty(len(field_parameter), dtype = np.int64)
+	for p, size in enumerate(sizes): 
+		selected = field_parameter == p
+		field_length[selected] = rng.choice(size, np.count_nonzero(selected))
+	field_flush = (i[field_iteration] + frequency_buffer - 1) // frequency_buffer
+	# a packet is a run of the same parameter within one flush
+	run_start = np.flatnonzero(np.r_[True, (field_parameter[1:] != field_parameter[:-1]) | (field_flush[1:] != field_flush[:-1])])
+	run_length = np.add.reduceat(field_length, run_start)
+	run_flush = field_flush[run_start]
+	run_first = np.r_[True, run_flush[1:] != run_flush[:-1]] # the first run in the buffer is sent last, without processing delay
+	order = np.lexsort((-np.arange(len(run_start)), run_flush)) # layer_transport sends each buffer from its end
+	pkt_length = run_length[order] + pkt_header_length
+	pkt_parameter = parameters[field_parameter[run_start]][order]
+	pkt_flush = run_flush[order]
+	flush_start = np.r_[True, pkt_flush[1:] != pkt_flush[:-1]]
+	delay = np.zeros(len(order))
+	delay[flush_start] = process_delays(rng.exponential(0.2, np.count_nonzero(flush_start)) * 0.01 + 0.015) # sleep_dl of layer_transport
+	delay += delay_batch(0.95, ~run_first[order], rng)
+	pkt_time = time_virtual + np.cumsum(delay) + np.arange(1, len(order) + 1) * time_processing_virtual
+	return pkt_time, pkt_length, pkt_parameter, pkt_time[-1]
+
+# ======== Batch engine - uplink packets of the buffer flushes flush_first..flush_last
+def generate_batch_uplink(flush_first, flush_last, rng, time_virtual):
+	i = np.arange(0 if flush_first == 0 else (flush_first - 1) * frequency_buffer + 1, flush_last * frequency_buffer + 1)
+	iteration_length = np.where(i % frequency_video == 0, np.maximum(rng.normal(*size_video, len(i)).astype(np.int64), 0), 0)
+	iteration_length += np.where(i % frequency_imustatus_rotorstatus == 0, 
+			rng.choice(size_rotorstatus, len(i)) + rng.choice(size_imustatus, len(i)), 0)
+	iteration_length += np.where(i % frequency_batterystatus_camerastatus == 0, 
+			rng.choice(size_camerastatus, len(i)) + rng.choice(size_batterystatus, len(i)), 0)
+	flush_length = np.bincount((i + frequency_buffer - 1) // frequency_buffer - flush_first, weights = iteration_length).astype(np.int64)
+	flush_packets = -(-flush_length // pkt_length_maximum)
+	pkt_flush = np.repeat(np.arange(len(flush_length)), flush_packets)
+	j = np.arange(len(pkt_flush)) - np.repeat(np.cumsum(flush_packets) - flush_packets, flush_packets) # packet index within its flush
+	remaining = flush_length[pkt_flush] - j * (pkt_length_maximum + 1) # layer_transport slices pkt_length_maximum + 1 bytes per packet
+	last = j == flush_packets[pkt_flush] - 1
+	pkt_length = np.where(last, np.maximum(remaining, 0), np.clip(remaining, 0, pkt_length_maximum + 1)) + pkt_header_length
+	pkt_parameter = np.full(len(pkt_flush), ord('v'), dtype = np.uint8)
+	delay = delay_batch(0.8, j > 0, rng)
+	pkt_time = time_virtual + np.cumsum(delay) + np.arange(1, len(pkt_flush) + 1) * time_processing_virtual
+	return pkt_time, pkt_length, pkt_parameter, pkt_time[-1]
+
+# ======== Generate one channel as packet arrays on the simulated clock - in worker processes, or packet by packet. Runs with --batch or --model and no workers use TrafficGenerator
+def generate_channel(batch, downlink, model, num_packets, seed, workers):
+	if workers:
+		return generate_parallel(batch, downlink, model, num_packets, seed, workers) # run segments in worker processes, each dispatched by generate_segment
+	return generate_packets(downlink, num_packets, rng_create(seed, pkt_direction_downlink if downlink else pkt_direction_uplink)) # independent stream per channel
+
+# ======== Chunks of one channel on the simulated clock - endless, flushes buffer flushes or model_packets packets at a time
+def generate_chunks(downlink, flushes, model, model_packets, rng):
+	flush, time_virtual = 0, 0.0
+	while True:
+		if model:
+			chunk_time, chunk_length, chunk_parameter, time_virtual = generate_model(model_channel(model, downlink), model_packets, rng, time_virtual)
+		elif downlink:
+			chunk_time, chunk_length, chunk_parameter, time_virtual = generate_batch_downlink(flush, flush + flushes - 1, rng, time_virtual)
+		else:
+			chunk_time, chunk_length, chunk_parameter, time_virtual = generate_batch_uplink(flush, flush + flushes - 1, rng, time_virtual)
+		flush += flushes
+		yield chunk_time, chunk_length, chunk_parameter
+
+# ======== Empirical sampler - packets drawn from an alias table in O(1) each, continuing the simulated clock at time_virtual
+def generate_empirical(table, num_packets, rng, time_virtual):
+	column = rng.integers(0, len(table['probability']), num_packets)
+	entry = np.where(rng.random(num_packets) < table['probability'][column], column, table['alias'][column])
+	interarrival_bin = table['bin'][entry]
+	pkt_interarrival = table['interarrival'][table['bin_start'][interarrival_bin] + (rng.random(num_packets) * table['bin_count'][interarrival_bin]).astype(np.int64)] # observed value of the bin
+	pkt_time = time_virtual + np.cumsum(pkt_interarrival)
+	pkt_parameter = np.full(num_packets, ord(model_parameter), dtype = np.uint8)
+	return pkt_time, table['length'][entry].astype(np.int64), pkt_parameter, float(pkt_time[-1]) if num_packets else time_virtual
+
+# ======== Model engine - packets sampled from the distributions fitted to a real trace, continuing the simulated clock at time_virtual
+def generate_model(model_channel, num_packets, rng, time_virtual):
+	if 'alias' in model_channel: # empirical alias table instead of fitted distributions
+		return generate_empirical(model_channel, num_packets, rng, time_virtual)
+	interarrival, length = model_channel['interarrival'], model_channel['length']
+	weights = np.asarray(interarrival['weights'])
+	component = rng.choice(len(weights), num_packets, p = weights / weights.sum())
+	pkt_interarrival = np.exp(rng.normal(np.asarray(interarrival['mean'])[component], np.asarray(interarrival['std'])[component])) # log-normal mixture
+	pkt_time = time_virtual + np.cumsum(pkt_interarrival)
+	weights = np.r_[length['weights'], 1 - sum(length['weights']) if length['rest'] else 0] # last choice is the rest of the lengths
+	choice = rng.choice(len(weights), num_packets, p = np.maximum(weights, 0) / np.maximum(weights, 0).sum())
+	pkt_length = np.r_[length['values'], 0].astype(np.int64)[choice]
+	rest = choice == len(length['values'])
+	if rest.any():
+		pkt_length[rest] = np.clip(np.rint(rng.normal(length['rest']['mean'], length['rest']['std'], rest.sum())), length['rest']['minimum'], length['rest']['maximum'])
+	pkt_parameter = np.full(num_packets, ord(model_parameter), dtype = np.uint8)
+	return pkt_time, pkt_length, pkt_parameter, float(pkt_time[-1]) if num_packets else time_virtual
+
+# ======== Generate packet arrays on the simulated clock with the per-packet engine
+def generate_packets(downlink, num_packets, rng):
+	buffer, pkt_length, pkt_list, pkt_time = [], [], PacketList(flows_create([])), []
+	i, time_virtual = 0, 0.0
+	while len(pkt_list) < num_packets:
+		buffer = layer_application(buffer, downlink, i, rng, not downlink) # run app layer
+		buffer, pkt_length, pkt_list, pkt_time, time_virtual = layer_transport( # run transport layer
+				buffer, downlink, i, pkt_length, pkt_list, pkt_time, rng, time_virtual, not downlink, True)
+		if i % frequency_buffer == 0:
+			sys.stdout.write("Number of generated packets = %d out of %d   \r" %(len(pkt_list), num_packets))
+			sys.stdout.flush()
+		i += 1
+	return (np.frombuffer(pkt_list.time, dtype = np.float64)[:num_packets], np.frombuffer(pkt_list.length, dtype = np.uint16)[:num_packets].astype(np.int64), 
+			np.frombuffer(pkt_list.parameter, dtype = np.uint8)[:num_packets])
+
+# ======== Parallel generation - segments of segment_packets generated in worker processes and merged in time
+def generate_parallel(batch, downlink, model, num_packets, seed, workers):
+	from concurrent.futures import ProcessPoolExecutor # only loaded for --workers
+	pkt_time, pkt_length, pkt_parameter = [], [], []
+	segments = math.ceil(num_packets / segment_packets)
+	sizes = [min(segment_packets, num_packets - segment * segment_packets) for segment in range(segments)]
+	time_offset = 0.0
+	with ProcessPoolExecutor(max_workers = workers, initializer = worker_init) as executor:
+		for segment_time, segment_length, segment_parameter in executor.map(generate_segment, 
+				[batch] * segments, [downlink] * segments, [model] * segments, sizes, [seed] * segments, range(segments)): # results arrive in segment order
+			pkt_time.append(segment_time + time_offset) # each segment continues where the previous one ends
+			pkt_length.append(segment_length)
+			pkt_parameter.append(segment_parameter)
+			time_offset = pkt_time[-1][-1]
+			sys.stdout.write("Number of generated packets = %d out of %d   \r" %(sum(map(len, pkt_time)), num_packets))
+			sys.stdout.flush()
+	return np.concatenate(pkt_time), np.concatenate(pkt_length), np.concatenate(pkt_parameter)
+
+# ======== Target rate - factor of the packet times so that a trace of length bytes ending at time_last (s) averages rate (kbps) from the start of the clock
+def generate_rate(length, time_last, rate):
+	if time_last <= 0: 
+		return 1.0
+	return length * 8 / 1000 / rate / time_last # multiply by 8 to convert bytes to bits, divide by 1000 to convert into kbps
+
+# ======== Stopping targets - True once num_packets, the packet time time_end (s) or target_bytes is reached, whichever is given and comes first
+def generate_reached(count, length, time_last, num_packets, time_end, target_bytes):
+	return ((num_packets is not None and count >= num_packets) or (time_end is not None and count > 0 and time_last >= time_end) 
+			or (target_bytes is not None and length >= target_bytes))
+
+# ======== Parallel generation - one segment of the trace on a simulated clock starting at 0, seeded by its index
+def generate_segment(batch, downlink, model, num_packets, seed, segment):
+	rng = rng_create(seed, pkt_direction_downlink if downlink else pkt_direction_uplink, segment)
+	if model:
+		return generate_model(model_channel(model, downlink), num_packets, rng, 0.0)[:3]
+	if batch:
+		return generate_batch(downlink, num_packets, rng)
+	return generate_packets(downlink, num_packets, rng)
+
+# ======== Stream of one UAV - chunks of up to generator_chunk_packets packets from TrafficGenerator, times multiplied by time_scale
+def generate_stream(channel, model, num_packets, seed, duration = None, target_bytes = None, time_scale = 1.0):
+	generator = TrafficGenerator(channel, model = model, seed = seed)
+	count, length, time_last = 0, 0, 0.0
+	while not generate_reached(count, length, time_last, num_packets, duration, target_bytes):
+		chunk = generator_chunk_packets if num_packets is None else min(generator_chunk_packets, num_packets - count)
+		pkt_time, pkt_length, pkt_parameter, pkt_direction = generator.generate(chunk, # each chunk continues the targets of the previous ones
+				None if duration is None else duration - generator.time_last, None if target_bytes is None else target_bytes - length)
+		if len(pkt_time):
+			count, length, time_last = count + len(pkt_time), length + int(pkt_length.sum()), float(pkt_time[-1])
+			yield pkt_time * time_scale, pkt_length, pkt_parameter, pkt_direction, 0
+		sys.stdout.write("Number of generated packets = %d   \r" %count if num_packets is None else "Number of generated packets = %d out of %d   \r" %(count, num_packets))
+		sys.stdout.flush()
+		if len(pkt_time) < chunk: 
+			break # target reached within the chunk
+
+# ======== Stopping targets - packets up to the first target reached: num_packets, packets before time_end (s) or the packet that reaches target_bytes
+def generate_end(pkt_length, pkt_time, num_packets, time_end, target_bytes):
+	end = len(pkt_time) if num_packets is None else min(num_packets, len(pkt_time))
+	if time_end is not None: end = min(end, int(np.searchsorted(pkt_time, time_end)))
+	if target_bytes is not None: end = min(end, int(np.searchsorted(np.cumsum(pkt_length), target_bytes)) + 1)
+	return end
+
+# ======== Fleet - packets of all UAV channels on a shared timeline, scheduled with a priority queue
+def generate_fleet(fleet, model, num_packets, seed, duration = None, target_bytes = None, time_scale = 1.0): # chunks of up to fleet_merge_packets packets, times multiplied by time_scale
+	flows = []
+	for uav, settings in enumerate(fleet):
+		for downlink in ([True, False] if settings['channel'] == 'bidirectional' else [settings['channel'] == 'downlink']):
+			direction = pkt_direction_downlink if downlink else pkt_direction_uplink
+			flows.append(generate_flow(downlink, model, rng_create(seed, direction, 0, uav), settings['time_scale'], settings['start'], uav)) # independent stream per UAV channel
+	scheduler = heapq.merge(*flows) # earliest packet of all UAV channels first, O(log K) per packet
+	count, length, time_last = 0, 0, 0.0
+	while not generate_reached(count, length, time_last, num_packets, duration, target_bytes):
+		chunk = list(itertools.islice(scheduler, fleet_merge_packets if num_packets is None else min(fleet_merge_packets, num_packets - count)))
+		pkt_time, pkt_uav, pkt_direction, pkt_length, pkt_parameter = (np.array(column) for column in zip(*chunk))
+		end = generate_end(pkt_length, pkt_time, None, duration, None if target_bytes is None else target_bytes - length) # the chunk can overshoot the time and bytes targets
+		if end:
+			count, length, time_last = count + end, length + int(pkt_length[:end].sum()), float(pkt_time[end - 1])
+			yield (pkt_time[:end] * time_scale, pkt_length[:end], pkt_parameter[:end].astype(np.uint8), pkt_direction[:end].astype(np.uint8), pkt_uav[:end])
+		sys.stdout.write("Number of generated packets = %d   \r" %count if num_packets is None else "Number of generated packets = %d out of %d   \r" %(count, num_packets))
+		sys.stdout.flush()
+		if end < len(pkt_time): 
+			break # target reached within the chunk
+
+# ======== Fleet - packets of one UAV channel in time order as (time, uav, direction, length, parameter), generated lazily by the batch engine
+def generate_flow(downlink, model, rng, time_scale, time_start, uav):
+	direction = pkt_direction_downlink if downlink else pkt_direction_uplink
+	for chunk_time, chunk_length, chunk_parameter in generate_chunks(downlink, fleet_flushes, model, fleet_model_packets, rng):
+		yield from zip((time_start + chunk_time * time_scale).tolist(), itertools.repeat(uav), itertools.repeat(direction), chunk_length.tolist(), chunk_parameter.tolist())
+
+# ======== Generate data for downlink channel - (parameter, length) records
+def generate_data_downlink(rng):
+	land_takeoff = ('t', rng.choice(size_land_takeoff))
+	pitch_roll = ('r', rng.choice(size_pitch_roll))
+	return_home = ('h', rng.choice(size_return_home))
+	throttle_yaw =  ('l', rng.choice(size_throttle_yaw))
 
 	return land_takeoff, pitch_roll, return_home, throttle_yaw
 
-# ======== Generate data for uplink channel
-def generate_data_uplink():
+# ======== Generate data for uplink channel - (parameter, length) records
+def generate_data_uplink(rng):
 	# telemetry data
-	batterystatus =  'b' * np.random.choice([2**5, 2**6])
-	camerastatus = 'm' * np.random.choice([2**5, 2**6])
-	imustatus = 'i' * np.random.choice([2**5, 2**6])
-	rotorstatus = 'o' * np.random.choice([2**5, 2**6])
+	batterystatus =  ('b', rng.choice(size_batterystatus))
+	camerastatus = ('m', rng.choice(size_camerastatus))
+	imustatus = ('i', rng.choice(size_imustatus))
+	rotorstatus = ('o', rng.choice(size_rotorstatus))
 	# video data
-	video = 'v' * int(np.random.normal(3000, 1500)) 
+	video = ('v', max(int(rng.normal(*size_video)), 0))
 
 	return batterystatus, camerastatus, imustatus, rotorstatus, video
 
 # ======== Generate distribution graphs
-def graph_generate(datarate, downlink, filename_extension, pkt_interarrival, pkt_length):
+def graph_generate(datarate, downlink, filename_extension, pkt_interarrival, pkt_length, show): # online statistics of each metric
 	cnt = 0
-	fig, host = prepare_graph()
-	datarate = list(filter(None, datarate)) # remove empty entries
+	fig, host = prepare_graph(show)
 	#print(datarate)
 	for i in [datarate, pkt_interarrival, pkt_length]:
 		host[0, cnt] = histogram(numofbins[cnt], i, label_x[cnt], label_y, host[0, cnt]) # generate hist graphs
@@ -128,10 +1133,12 @@ def graph_generate(datarate, downlink, filename_extension, pkt_interarrival, pkt
 	return fig
 
 # ======== Generate histogram plot
-def histogram(bins, data, label_x, label_y, plot):
+def histogram(bins, statistics, label_x, label_y, plot):
+	values, counts = statistics.histogram() # fine bins of the online statistics, regrouped into the bins of the graph
 	plot.hist(
-			data,
+			values,
 			bins = bins,
+			weights = counts,
 			color = 'steelblue',
 			edgecolor = 'dimgrey',
 			density = True,
@@ -145,102 +1152,247 @@ def histogram(bins, data, label_x, label_y, plot):
 	return plot
 
 # ======== Application layer - Generate data based on the applications
-def layer_application(buffer, downlink, i, uplink):
+def layer_application(buffer, downlink, i, rng, uplink):
 	if downlink:
-		land_takeoff, pitch_roll, return_home, throttle_yaw = generate_data_downlink() # fetch data
+		land_takeoff, pitch_roll, return_home, throttle_yaw = generate_data_downlink(rng) # fetch data
 		buffer = data_to_buffer_downlink(buffer, i, land_takeoff, pitch_roll, # send data to buffer
 				return_home, throttle_yaw)
 	else:
-		batterystatus, camerastatus, imustatus, rotorstatus, video = generate_data_uplink() # fetch data
+		batterystatus, camerastatus, imustatus, rotorstatus, video = generate_data_uplink(rng) # fetch data
 		buffer = data_to_buffer_uplink(batterystatus, buffer, camerastatus, i, # send data to buffer
 				imustatus, rotorstatus, video)
 	return buffer
 
 # ======== Transport layer - Check the UDP buffer and generate packets
-def layer_transport(buffer, datarate, downlink, firstrun, i, num_packets,
-		pkt_interarrival, pkt_length, pkt_length_total, pkt_list, time_previous, uplink):
+def layer_transport(buffer, downlink, i, 
+		pkt_length, pkt_list, pkt_time, rng, time_virtual, uplink, virtual_clock):
 	if i % frequency_buffer == 0:
-		first_loop = True
-		j, k = 0, 0
-		buffer_length = len(buffer)
 		if downlink: 
-			sleep_dl = np.random.exponential(0.2) * 0.01 + 0.015 # generate processing delay
-			time.sleep(sleep_dl)
-		while True:
-			if (downlink and len(buffer) == 0) or (uplink and (j == math.ceil(buffer_length / pkt_length_maximum))): # buffer is emptied, exit the loop
-				break
-			delayProb = np.random.uniform(0, 1)
-			
-			#if buffer[len(buffer) - 1 - k] == 'l' and buffer[len(buffer) - 2 - k] != 'l': # generate packets based on one parameter - old method
-			if (downlink and (buffer[len(buffer) - 1 - k] != buffer[len(buffer) - 2 - k])) or uplink: # generate packets per parameter - new method
-				if not first_loop and ((downlink and delayProb > 0.95) or (uplink and delayProb > 0.8)): # probability for processing delay. Probability for dl and ul different to make the 2nd peak obvious on DL
-					# time_sleep = 0 # np.random.exponential(0.2) * 0.05 # generate processing delay#time_sleep = np.random.uniform(0, frequency_buffer / 20) # generate processing delay for dl
-					time_sleep = np.random.exponential(0.2) * 0.05 # generate processing delay for ul
-					time.sleep(time_sleep)
-				if not first_loop and (delayProb > 0.97):
-					sleep_ul = np.random.exponential(1) * 0.01 + 0.025
-					time.sleep(sleep_ul)
-
-			#if downlink and buffer[len(buffer) - 1 - k] == 'l' and buffer[len(buffer) - 2 - k] != 'l': # generate packets based on one parameter - old method
-			if downlink and (buffer[len(buffer) - 1 - k] != buffer[len(buffer) - 2 - k]): # generate downlink packets
-				pkt = pkt_create(buffer[len(buffer) - 1 - k:]) # generate packet
-				buffer = buffer[:len(buffer) - 1 - k] # remove packet from buffer
-				datarate, firstrun, pkt, pkt_interarrival, pkt_length, pkt_length_total, pkt_list, time_previous = statistics_results(datarate, # generate stats
-						firstrun, pkt, pkt_interarrival, pkt_length, pkt_length_total, pkt_list, time_previous)
-				k = 0
-			elif downlink and k == len(buffer): 
-				pkt = pkt_create(buffer) # generate packet
-				buffer = '' # remove packet from buffer
-				datarate, firstrun, pkt, pkt_interarrival, pkt_length, pkt_length_total, pkt_list, time_previous = statistics_results(datarate, # generate stats
-						firstrun, pkt, pkt_interarrival, pkt_length, pkt_length_total, pkt_list, time_previous)
-				k = 0
-			elif downlink: 
-				k += 1
-			elif uplink: # generate uplink packets
-				if j == math.ceil(buffer_length / pkt_length_maximum) - 1: # last pkt
-				 	pkt = pkt_create(buffer) # generate packet
-				 	buffer = '' # buffer[:len(buffer) - 1 - pkt_length_maximum] # remove packet from buffer
-				 	datarate, firstrun, pkt, pkt_interarrival, pkt_length, pkt_length_total, pkt_list, time_previous = statistics_results(datarate, # generate stats
-				 			firstrun, pkt, pkt_interarrival, pkt_length, pkt_length_total, pkt_list, time_previous)
-				else: 
-					pkt = pkt_create(buffer[len(buffer) - 1 - pkt_length_maximum:]) # generate packet
-					buffer = buffer[:len(buffer) - 1 - pkt_length_maximum] # remove packet from buffer
-					datarate, firstrun, pkt, pkt_interarrival, pkt_length, pkt_length_total, pkt_list, time_previous = statistics_results(datarate, # generate stats
-							firstrun, pkt, pkt_interarrival, pkt_length, pkt_length_total, pkt_list, time_previous)
-				j += 1
-
-			first_loop = False	
-		sys.stdout.write("Number of generated packets = %d out of %d   \r" %(len(pkt_interarrival), num_packets))
-		sys.stdout.flush()
-	return buffer, datarate, firstrun, pkt_interarrival, pkt_length, pkt_length_total, pkt_list, time_previous
+			sleep_dl = rng.exponential(0.2) * 0.01 + 0.015 # generate processing delay
+			time_virtual = process_delay(sleep_dl, time_virtual, virtual_clock)
+			buffer_packets = len(buffer) # generate packets per parameter - each record is a run of one parameter
+		else:
+			buffer_packets = math.ceil(sum(length for parameter, length in buffer) / pkt_length_maximum)
+		for j in range(buffer_packets):
+			delayProb = rng.uniform(0, 1)
+			if (downlink and j < buffer_packets - 1) or (uplink and j > 0): # no delay for the first record of the dl buffer and the first ul packet
+				if (downlink and delayProb > 0.95) or (uplink and delayProb > 0.8): # probability for processing delay. Probability for dl and ul different to make the 2nd peak obvious on DL
+					time_sleep = rng.exponential(0.2) * 0.05 # generate processing delay for ul
+					time_virtual = process_delay(time_sleep, time_virtual, virtual_clock)
+				if delayProb > 0.97:
+					sleep_ul = rng.exponential(1) * 0.01 + 0.025
+					time_virtual = process_delay(sleep_ul, time_virtual, virtual_clock)
+
+			if downlink: # generate downlink packets from the end of the buffer
+				payload = [buffer.pop()] # remove packet from buffer
+			elif j == buffer_packets - 1: # last ul pkt
+				payload = buffer
+				buffer = [] # remove packet from buffer
+			else: 
+				payload = buffer_pop(buffer, pkt_length_maximum + 1) # remove packet from buffer
+			time_virtual += time_processing_virtual
+			pkt = pkt_create(payload, time_virtual, uplink, virtual_clock) # generate packet
+			pkt_length, pkt_list, pkt_time = statistics_results(pkt, pkt_length, pkt_list, pkt_time) # generate stats
+	return buffer, pkt_length, pkt_list, pkt_time, time_virtual
 
 # ======== Main function
 def main():
-	buffer = ''
-	pkt_list, pkt_interarrival, pkt_length, datarate = [], [], [], []
-	i, time_previous, pkt_length_total, j = 0, 0, 0, 0
+	buffer = [] # UDP buffer as (parameter, length) records
+	pkt_length, pkt_time = [], [] # packets of the current statistics block
+	i, j = 0, 0
+	time_virtual = 0.0 # simulated clock (s), only advanced with --virtual-clock
+	startup_main = time.perf_counter()
 	args, filename_extension, title = parse_args()
-	firstrun = True
+	startup_args = time.perf_counter()
+	instrumentation = Instrumentation(instrument_stages) if args.instrument else None # opt-in, the stages run untimed otherwise
+	if args.fit:
+		model_fit(args.fit) # fit the models and exit without generating traffic
+		if instrumentation: 
+			instrumentation.report(outputfolder + os.sep + date + '_fit_instrument', args.instrument, args.virtual_clock)
+		return
+	try:
+		model = model_load(args.model) if args.model else None
+		if args.empirical: model = empirical_load(args.empirical) # alias tables take the place of the fitted distributions
+	except (FileNotFoundError, ValueError) as error:
+		print(error)
+		sys.exit(0)
+	
+	fleet = fleet_create(args.channel, args.fleet_config, args.fleet, args.seed) if args.fleet else []
+	if args.bidirectional or args.fleet: # statistics and graphs per channel
+		channels = [(downlink, filename_extension + suffix, title + ' - ' + suffix[1:].capitalize()) for downlink, suffix in [(True, '_downlink'), (False, '_uplink')]
+				if not fleet or any(settings['channel'] in ['bidirectional', suffix[1:]] for settings in fleet)]
+	else:
+		channels = [(args.downlink, filename_extension, title)]
+	try:
+		for downlink, channel_extension, channel_title in channels:
+			if model: model_channel(model, downlink)
+	except ValueError as error:
+		print(error)
+		sys.exit(0)
+	if args.scapy:
+		pkt_list = PacketList(flows_create(fleet)) # kept until the end of the run, then serialized by scapy
+	else:
+		pkt_list = PcapStreamWriter(outputfolder + os.sep + date + filename_extension + '.' + outputfile_packets_extension, flows_create(fleet)) # packets are written as they are generated
+	if args.send:
+		pkt_list = (AsyncUdpSender if args.send_async else UdpSender)(args.send, pkt_list, args.send_speed) # packets are sent live and passed on to be saved
+	statistics = [ChannelStatistics(outputfolder + os.sep + date + channel_extension, args.stats_format == 'npy', args.window) 
+			for downlink, channel_extension, channel_title in channels] # statistics files and online statistics of each channel
+	if args.profile_startup:
+		profile_startup([('Imports', startup_imports), ('Module', startup_main - startup_time - startup_imports), 
+				('Arguments', startup_args - startup_main), ('Setup', time.perf_counter() - startup_args)])
+	
+	rng = rng_create(args.seed, pkt_direction_uplink if args.uplink else pkt_direction_downlink) # independent stream per channel
 	
 	print("\nPacket generation begins on %s channel" %title)
+	print("Seed: %d" %args.seed)
 	starttime = time.time()
+	duration, target_bytes = args.duration, args.target_bytes
+	if args.target_rate and duration: # at the target rate, the duration is a number of bytes. Times are scaled once the trace is generated
+		duration, target_bytes = None, min(target_bytes or math.inf, math.ceil(args.target_rate * 1000 / 8 * args.duration)) # multiply by 1000 and divide by 8 to convert kbps to bytes per s
+	if args.fleet or ((args.batch or model) and not args.workers):
+		if args.fleet: # run scheduler over all UAVs
+			stream = functools.partial(generate_fleet, fleet, model, args.n, args.seed, duration, target_bytes)
+		else: # run vectorized engine
+			stream = functools.partial(generate_stream, args.channel, model, args.n, args.seed, duration, target_bytes)
+		time_scale = 1.0
+		if args.target_rate: # the factor needs the bytes and the end of the whole trace, taken from a first pass over the same streams
+			length, time_last = 0, 0.0
+			for pkt_time, pkt_length, pkt_parameter, pkt_direction, pkt_uav in stream():
+				length, time_last = length + int(pkt_length.sum()), float(pkt_time[-1])
+			time_scale = generate_rate(length, time_last, args.target_rate)
+		for pkt_time, pkt_length, pkt_parameter, pkt_direction, pkt_uav in stream(time_scale):
+			pkt_list.extend(pkt_direction, pkt_length, pkt_parameter, pkt_time, pkt_uav) # each chunk is saved and dropped, memory does not grow with the run
+			for (downlink, channel_extension, channel_title), channel_statistics in zip(channels, statistics):
+				selected = pkt_direction == (pkt_direction_downlink if downlink else pkt_direction_uplink)
+				save_statistics(channel_statistics, pkt_length[selected], pkt_time[selected])
+	elif args.bidirectional or args.workers:
+		pkt_time, pkt_length, pkt_parameter, pkt_direction = [], [], [], []
+		for downlink, channel_extension, channel_title in channels:
+			channel_time, channel_length, channel_parameter = generate_channel(args.batch, downlink, model, args.n, args.seed, args.workers)
+			pkt_time.append(channel_time)
+			pkt_length.append(channel_length)
+			pkt_parameter.append(channel_parameter)
+			pkt_direction.append(np.full(len(channel_time), pkt_direction_downlink if downlink else pkt_direction_uplink, dtype = np.uint8))
+		order = np.argsort(np.concatenate(pkt_time), kind = 'stable')[:args.n] # interleave the channels on the shared clock
+		pkt_time, pkt_length, pkt_parameter, pkt_direction = (np.concatenate(column)[order] for column in (pkt_time, pkt_length, pkt_parameter, pkt_direction))
+		pkt_list.extend(pkt_direction, pkt_length, pkt_parameter, pkt_time)
+		for (downlink, channel_extension, channel_title), channel_statistics in zip(channels, statistics):
+			selected = pkt_direction == (pkt_direction_downlink if downlink else pkt_direction_uplink)
+			save_statistics(channel_statistics, pkt_length[selected], pkt_time[selected]) # generate stats
 	# main loop
-	while True:
-		buffer = layer_application(buffer, args.downlink, i, args.uplink) # run app layer
-		buffer, datarate, firstrun, pkt_interarrival, pkt_length, pkt_length_total, pkt_list, time_previous = layer_transport( # run transport layer
-				buffer, datarate, args.downlink, firstrun, i, int(args.n), pkt_interarrival, pkt_length, 
-				pkt_length_total, pkt_list, time_previous, args.uplink)
+	while not (args.batch or args.bidirectional or args.fleet or model or args.workers):
+		buffer = layer_application(buffer, args.downlink, i, rng, args.uplink) # run app layer
+		buffer, pkt_length, pkt_list, pkt_time, time_virtual = layer_transport( # run transport layer
+				buffer, args.downlink, i, pkt_length, 
+				pkt_list, pkt_time, rng, time_virtual, args.uplink, args.virtual_clock)
+		count = statistics[0].length.count + len(pkt_time)
+		if len(pkt_time) >= statistics_flush_rows or count >= int(args.n): 
+			save_statistics(statistics[0], pkt_length, pkt_time) # write the block and drop its samples
+			pkt_length, pkt_time = [], []
+		if i % frequency_buffer == 0:
+			sys.stdout.write("Number of generated packets = %d out of %d   \r" %(count, int(args.n)))
+			sys.stdout.flush()
 		i += 1
 		
-		if len(pkt_interarrival) >= int(args.n): break # requested number of packets generated
+		if count >= int(args.n): 
+			break # requested number of packets generated
 
-	print("\nPacket generation is completed!\nGraph is being prepared, please hold on...")
+	print("\nPacket generation is completed!" + ("" if args.no_plot else "\nGraph is being prepared, please hold on..."))
 	exectime = float(time.time()) - starttime
 	print("Total execution time: %d s" %exectime)
-	fig = graph_generate(datarate, args.downlink, filename_extension, pkt_interarrival, pkt_length) # generate graph
-	save_output(datarate, fig, filename_extension, pkt_interarrival, pkt_length, pkt_list, title) # save all output files
+	for (downlink, channel_extension, channel_title), channel_statistics in zip(channels, statistics):
+		channel_statistics.summary(channel_title)
+		fig = None if args.no_plot else graph_generate( # generate graph
+				channel_statistics.datarate, downlink, channel_extension, channel_statistics.interarrival, channel_statistics.length, not args.no_show)
+		save_output(channel_statistics, fig, channel_extension, channel_title) # save graph and statistics
+	save_packets(filename_extension, pkt_list)
+	if args.validate:
+		validation_run(channels, args.validate, filename_extension, statistics, args.window) # compare with the real trace, once the files are saved
+	if instrumentation:
+		instrumentation.report(outputfolder + os.sep + date + filename_extension + '_instrument', args.instrument, args.virtual_clock, not args.workers)
 	print("\n\nDone!")
-	show_graph()
+	if not (args.no_plot or args.no_show): 
+		show_graph()
+
+# ======== Model - distributions of one channel of a model or alias tables, a channel that was not fitted is an error
+def model_channel(model, downlink):
+	channel = 'downlink' if downlink else 'uplink'
+	if model.get(channel) is None:
+		raise ValueError("The model%s has no %s channel, its trace has fewer than two %s packets." %(' ' + model['device'] if 'device' in model else '', channel, channel))
+	return model[channel]
+
+# ======== Model - fit the distributions of every trace in the archive, or of a single pcap trace, and save one model file per device
+def model_fit(filename):
+	os.makedirs(modelfolder, exist_ok = True)
+	members = [None] # a pcap trace is read memory-mapped
+	if zipfile.is_zipfile(filename):
+		with zipfile.ZipFile(filename) as archive:
+			members = [member for member in sorted(archive.namelist()) if member.endswith('.' + outputfile_packets_extension)]
+	for member in members:
+		name = os.path.splitext(os.path.basename(member or filename))[0].replace(model_trace_suffix, '')
+		print("Fitting the model of %s..." %name)
+		pkt_time, pkt_length, pkt_source, pkt_destination = trace_read(filename, member)
+		if len(pkt_time) == 0:
+			print("No UDP packets in %s, skipped." %(member or filename))
+			continue
+		ip_ground, ip_uav, downlink, uplink = trace_channels(pkt_length, pkt_source, pkt_destination)
+		if downlink.sum() < 2 and uplink.sum() < 2:
+			print("Fewer than two UDP packets per direction in %s, skipped." %(member or filename))
+			continue
+		model = {'device': name, 'trace': member or filename, 'ip_ground': str(ipaddress.ip_address(int(ip_ground))), 'ip_uav': str(ipaddress.ip_address(int(ip_uav)))}
+		for channel, selected in [('downlink', downlink), ('uplink', uplink)]:
+			model[channel] = None # an inter-arrival needs two packets
+			if selected.sum() < 2:
+				print("Fewer than two %s packets in %s, the %s channel is not fitted." %(channel, member or filename, channel))
+			else:
+				model[channel] = model_fit_channel(pkt_length[selected], pkt_time[selected])
+		with open(modelfolder + os.sep + name + '.json', 'w') as model_file:
+			json.dump(model, model_file, indent = 1)
+		print("Saved %s with %d downlink and %d uplink packets." %(modelfolder + os.sep + name + '.json', downlink.sum(), uplink.sum()))
+
+# ======== Model - distributions of one direction of a trace. Inter-arrival is a log-normal mixture, lengths are the most frequent values and a normal rest
+def model_fit_channel(pkt_length, pkt_time):
+	weights, mean, std = model_fit_mixture(np.log(np.maximum(np.diff(pkt_time), model_interarrival_minimum)), model_components)
+	values, count = np.unique(pkt_length, return_counts = True)
+	top = np.sort(np.argsort(count, kind = 'stable')[::-1][:model_lengths])
+	rest = pkt_length[~np.isin(pkt_length, values[top])]
+	datarate = statistics_datarate(pkt_length, pkt_time - pkt_time[0], statistics_window)[1] # for reference, the data rate follows from the other two
+	return {'packets': len(pkt_time),
+			'interarrival': {'weights': weights.tolist(), 'mean': mean.tolist(), 'std': std.tolist()}, # of ln(s)
+			'length': {'values': values[top].tolist(), 'weights': (count[top] / len(pkt_length)).tolist(), 
+					'rest': {'mean': float(rest.mean()), 'std': float(max(rest.std(), model_std_minimum)), 'minimum': int(rest.min()), 'maximum': int(rest.max())} if len(rest) else None},
+			'datarate': {'mean': float(datarate.mean()) if len(datarate) else 0.0, 'std': float(datarate.std()) if len(datarate) else 0.0}} # kbps
+
+# ======== Model - Gaussian mixture of the samples fitted with expectation maximization, returns weights, means and standard deviations
+def model_fit_mixture(samples, components):
+	weights = np.full(components, 1 / components)
+	mean = np.quantile(samples, (np.arange(components) + 0.5) / components) # spread the components over the data
+	std = np.full(components, max(samples.std() / components, model_std_minimum))
+	likelihood_previous = -np.inf
+	for iteration in range(model_fit_iterations):
+		log_density = np.log(np.maximum(weights, 1e-300)) - np.log(std) - 0.5 * ((samples[:, None] - mean) / std)**2 # constant term cancels out
+		log_density_maximum = log_density.max(axis = 1, keepdims = True)
+		density = np.exp(log_density - log_density_maximum) # scaled to avoid underflow
+		density_total = density.sum(axis = 1, keepdims = True)
+		responsibility = density / density_total
+		likelihood = np.mean(log_density_maximum + np.log(density_total))
+		responsibility_total = np.maximum(responsibility.sum(axis = 0), 1e-300)
+		weights = responsibility_total / len(samples)
+		mean = (responsibility * samples[:, None]).sum(axis = 0) / responsibility_total
+		std = np.maximum(np.sqrt((responsibility * (samples[:, None] - mean)**2).sum(axis = 0) / responsibility_total), model_std_minimum)
+		if likelihood - likelihood_previous < model_fit_tolerance: 
+			break
+		likelihood_previous = likelihood
+	return weights, mean, std
+
+# ======== Model - load the model file of a device
+def model_load(name):
+	filename = modelfolder + os.sep + name + '.json'
+	if not os.path.exists(filename):
+		models = sorted(os.path.splitext(model_file)[0] for model_file in os.listdir(modelfolder)) if os.path.isdir(modelfolder) else []
+		raise FileNotFoundError("There is no model named %s.\nAvailable models: %s. Fit them with --fit." %(name, ', '.join(models) or 'none'))
+	with open(filename) as model_file:
+		return json.load(model_file)
 
 # ======== Parse user inputs
 def parse_args():
@@ -248,8 +1400,8 @@ def parse_args():
 
 	parser.add_argument('-n',
 						action = "store",
-						help = "Number of packets to generate. 5000 is default",
-						default = 5000,
+						help = "Number of packets to generate. 5000 is default, unless --duration or --target-bytes is given",
+						default = None,
 						required = False)
 
 	parser.add_argument('--uplink', '-u',
@@ -258,9 +1410,183 @@ def parse_args():
 						default = False,
 						required = False)
 
+	parser.add_argument('--bidirectional', '-b',
+						action = "store_true",
+						help = "Generate downlink and uplink channels together on the simulated clock, interleaved in one pcap. -n counts the packets of both channels.",
+						default = False,
+						required = False)
+
+	parser.add_argument('--batch',
+						action = "store_true",
+						help = "Generate the whole trace with vectorized draws on the simulated clock. Otherwise, packets are generated one by one.",
+						default = False,
+						required = False)
+
+	parser.add_argument('--fleet',
+						action = "store",
+						type = int,
+						help = "Generate the traffic of this many UAVs with one ground station on the simulated clock. The channel of each UAV follows --uplink and --bidirectional. -n counts the packets of the whole fleet.",
+						default = None,
+						required = False)
+
+	parser.add_argument('--fleet-config',
+						action = "store",
+						help = "JSON file with a list of per-UAV settings (channel, ip, port, start, time_scale) that override the defaults of the fleet.",
+						default = None,
+						required = False)
+
+	parser.add_argument('--duration',
+						action = "store",
+						type = float,
+						help = "Stop after this many seconds of traffic on the simulated clock, or of sending with --send. Whichever of -n, --duration and --target-bytes is reached first ends the run.",
+						default = None,
+						required = False)
+
+	parser.add_argument('--empirical',
+						action = "store",
+						help = "Sample inter-arrival and length jointly from alias tables of a real trace, e.g. djispark, or of a csv or npy statistics file of a previous run, on the simulated clock. The tables are cached in %s." %cachefolder,
+						default = None,
+						required = False)
+
+	parser.add_argument('--fit',
+						action = "store",
+						nargs = '?',
+						const = model_archive,
+						help = "Fit the models of the devices in a zip archive of pcap traces, or in one pcap trace, to the %s folder and exit. %s is default." %(os.path.basename(modelfolder), os.path.basename(model_archive)),
+						default = None,
+						required = False)
+
+	parser.add_argument('--instrument',
+						nargs = '?',
+						choices = ['json', 'prometheus'],
+						const = 'json',
+						help = "Time the stages of the run and count the processing delays. A summary is printed at the end and saved in json (default) or Prometheus text format.",
+						default = None,
+						required = False)
+
+	parser.add_argument('--model',
+						action = "store",
+						help = "Sample the packets from the distributions fitted to a real trace, e.g. djispark, on the simulated clock. Otherwise, the buffer model is default.",
+						default = None,
+						required = False)
+
+	parser.add_argument('--no-plot',
+						action = "store_true",
+						help = "Headless run without graphs, matplotlib is not loaded. Statistics and packets are saved as usual.",
+						default = False,
+						required = False)
+
+	parser.add_argument('--no-show',
+						action = "store_true",
+						help = "Save the graphs without opening a window, e.g. for batch runs. Otherwise, the graphs are shown at the end of the run.",
+						default = False,
+						required = False)
+
+	parser.add_argument('--profile-startup',
+						action = "store_true",
+						help = "Print the time spent on imports, arguments and setup before the generation begins, compared with the startup budget.",
+						default = False,
+						required = False)
+
+	parser.add_argument('--scapy',
+						action = "store_true",
+						help = "Keep the packets until the end of the run and write the pcap with scapy. Otherwise, packets are streamed to the pcap as they are generated.",
+						default = False,
+						required = False)
+
+	parser.add_argument('--send',
+						action = "store",
+						help = "Send the packets live as UDP datagrams to HOST[:PORT], paced by their timestamps. Port %d is default. The pcap and statistics are saved as well." %port_destination,
+						default = None,
+						required = False)
+
+	parser.add_argument('--send-async',
+						action = "store_true",
+						help = "Send each UAV flow of --send from its own coroutine and socket on one asyncio event loop. Otherwise, packets are sent one after another in time order.",
+						default = False,
+						required = False)
+
+	parser.add_argument('--send-speed',
+						action = "store",
+						type = float,
+						help = "Replay speed of --send, e.g. 2 sends twice as fast as the timestamps. 0 sends as fast as possible. 1 is default.",
+						default = 1.0,
+						required = False)
+
+	parser.add_argument('--seed',
+						action = "store",
+						type = int,
+						help = "Seed of the random number generator. Runs with --virtual-clock or --batch and the same seed produce identical output. Random seed is default.",
+						default = None,
+						required = False)
+
+	parser.add_argument('--stats-format',
+						action = "store",
+						choices = [outputfile_statistics_extension, 'npy'],
+						help = "File format of the statistical results. npy is a binary NumPy array with one field per column. csv is default.",
+						default = outputfile_statistics_extension,
+						required = False)
+
+	parser.add_argument('--target-bytes',
+						action = "store",
+						type = int,
+						help = "Stop once the packets add up to this many bytes, IP & UDP headers included.",
+						default = None,
+						required = False)
+
+	parser.add_argument('--target-rate',
+						action = "store",
+						type = float,
+						help = "Scale the packet inter-arrival times so that the traffic averages this data rate (kbps). With --duration, the run ends once the bytes of the duration at this rate are generated.",
+						default = None,
+						required = False)
+
+	parser.add_argument('--window',
+						action = "store",
+						type = float,
+						help = "Window of the data rate in seconds, e.g. 0.1 for a finer throughput analysis. %g is default." %statistics_window,
+						default = statistics_window,
+						required = False)
+
+	parser.add_argument('--workers',
+						action = "store",
+						type = int,
+						help = "Generate the trace in segments of %d packets with this many worker processes on the simulated clock. The output does not depend on the number of workers." %segment_packets,
+						default = None,
+						required = False)
+
+	parser.add_argument('--validate',
+						action = "store",
+						help = "Compare the inter-arrival, length and data rate distributions of each channel with a real trace, e.g. djispark: KS distance, quantiles and autocorrelation. The report is saved as json.",
+						default = None,
+						required = False)
+
+	parser.add_argument('--virtual-clock',
+						action = "store_true",
+						help = "Advance a simulated clock by the processing delays instead of sleeping. Otherwise, wall clock is default.",
+						default = False,
+						required = False)
+
 	args = parser.parse_args()
 
-	if not args.uplink:
+	args.channel = 'bidirectional' if args.bidirectional else ('uplink' if args.uplink else 'downlink')
+	if args.fleet is not None:
+		if args.fleet < 1:
+			print("Your input for --fleet is not valid.\nPlease provide a positive integer.")
+			sys.exit(0)
+		if args.fleet > 65536 - fleet_port_first: # one ground station port per UAV
+			print("Your input for --fleet is not valid.\nPlease provide at most %d UAVs, the ground station ports count up from %d." %(65536 - fleet_port_first, fleet_port_first))
+			sys.exit(0)
+		args.downlink, args.uplink = True, False
+		args.virtual_clock = True # UAVs share the simulated clock
+		filename_extension = '_fleet'
+		title = 'Fleet of %d UAVs' %args.fleet
+	elif args.bidirectional:
+		args.downlink, args.uplink = True, False
+		args.virtual_clock = True # channels share the simulated clock
+		filename_extension = '_bidirectional'
+		title = 'Bidirectional'
+	elif not args.uplink:
 		args.downlink = True
 		filename_extension = '_downlink'
 		title = 'Downlink'
@@ -269,25 +1595,97 @@ def parse_args():
 		filename_extension = '_uplink'
 		title = 'Uplink'
 
+	if args.n is None and args.duration is None and args.target_bytes is None: 
+		args.n = 5000
 	try:
-		args.n = int(args.n)
+		args.n = None if args.n is None else int(args.n)
 	except ValueError:
 		print("Your input for -n is not valid.\nPlease provide an integer.")
 		sys.exit(0)
 
+	if args.workers is not None and args.workers < 1:
+		print("Your input for --workers is not valid.\nPlease provide a positive integer.")
+		sys.exit(0)
+	if args.workers: args.virtual_clock = True # workers cannot share the wall clock
+	if args.batch: args.virtual_clock = True # the batch engine stamps the packets with the simulated clock
+	if args.model and args.empirical:
+		print("--model and --empirical cannot be used together.")
+		sys.exit(0)
+	if args.model: 
+		args.virtual_clock = True # packet times come from the fitted distributions
+		filename_extension += '_' + args.model
+		title += ' - Model %s' %args.model
+	if args.empirical:
+		args.virtual_clock = True
+		filename_extension += '_empirical_' + os.path.splitext(os.path.basename(args.empirical))[0]
+		title += ' - Empirical %s' %os.path.splitext(os.path.basename(args.empirical))[0]
+
+	if args.send:
+		host, separator, port = args.send.partition(':')
+		try:
+			args.send = (socket.gethostbyname(host), int(port) if separator else port_destination)
+			if not 0 < args.send[1] < 65536: raise ValueError # port out of range
+		except (socket.gaierror, ValueError):
+			print("Your input for --send is not valid.\nPlease provide HOST or HOST:PORT.")
+			sys.exit(0)
+	if args.send_async and not args.send:
+		print("--send-async needs --send.")
+		sys.exit(0)
+	if args.send_speed < 0:
+		print("Your input for --send-speed is not valid.\nPlease provide a non-negative number.")
+		sys.exit(0)
+
+	for name, value in [('--duration', args.duration), ('--target-bytes', args.target_bytes), ('--target-rate', args.target_rate)]:
+		if value is not None and value <= 0:
+			print("Your input for %s is not valid.\nPlease provide a positive number." %name)
+			sys.exit(0)
+	if args.duration or args.target_bytes or args.target_rate:
+		if args.workers:
+			print("--duration, --target-bytes and --target-rate cannot be used with --workers.")
+			sys.exit(0)
+		args.batch = args.virtual_clock = True # targets are evaluated on the arrays of the batch engine
+
+	if args.window <= 0:
+		print("Your input for --window is not valid.\nPlease provide a positive number.")
+		sys.exit(0)
+	if args.validate and args.validate not in trace_members(model_archive):
+		print("There is no trace named %s.\nAvailable traces: %s." %(args.validate, ', '.join(sorted(trace_members(model_archive)))))
+		sys.exit(0)
+
+	if args.seed is None:
+		args.seed = int(np.random.SeedSequence().entropy) # printed at the start of the run to reproduce it
+
 	return args, filename_extension, title
 
-# ======== Create packet
-def pkt_create(payload):
-	pkt = IP() / UDP() / Raw(load = payload) # add IP & UDP layers to the payload
-	pkt[IP].src = ip_source
-	pkt[IP].dst = ip_destination
-	pkt[UDP].sport = port_source 
-	pkt[UDP].dport = port_destination
-	return pkt
-
-# ======== Prepare subplots
-def prepare_graph(): 
+# ======== Create packet record from the (parameter, length) records of its payload
+def pkt_create(payload, time_virtual, uplink, virtual_clock):
+	return PacketRecord(
+			pkt_direction_uplink if uplink else pkt_direction_downlink, 
+			sum(length for parameter, length in payload) + pkt_header_length, # add IP & UDP layers to the payload
+			max(payload, key = lambda record: record[1])[0] if payload else 'v', # largest record names the packet
+			time_virtual if virtual_clock else time.time()) # timestamp from the simulated clock instead of the wall clock
+
+# ======== Build the scapy packet of a packet record, only used to serialize it
+def pkt_scapy(flows, pkt):
+	from scapy.layers.inet import IP, UDP # scapy is only loaded for --scapy
+	from scapy.packet import Raw
+	scapy_pkt = IP() / UDP() / Raw(load = pkt.parameter * (pkt.length - pkt_header_length)) # add IP & UDP layers to the payload
+	ip_ground, ip_uav, port_ground, port_uav = flows[pkt.uav]
+	uplink = pkt.direction == pkt_direction_uplink # uplink packets come back from the UAV
+	scapy_pkt[IP].src = ip_uav if uplink else ip_ground
+	scapy_pkt[IP].dst = ip_ground if uplink else ip_uav
+	scapy_pkt[UDP].sport = port_uav if uplink else port_ground 
+	scapy_pkt[UDP].dport = port_ground if uplink else port_uav
+	scapy_pkt.time = pkt.time
+	return scapy_pkt
+
+# ======== Prepare subplots - matplotlib is imported with the first graph, runs with --no-plot never load it
+def prepare_graph(show): 
+	import config_matplotlibrc
+	import matplotlib
+	if not show: 
+		matplotlib.use('Agg') # no window, the graphs are only saved
+	import matplotlib.pyplot as plt
 	plt.rcParams.update(config_matplotlibrc.parameters) # fetch parameters from config_matplotlibrc.py
 	fig, host = plt.subplots(
 			1,  
@@ -296,30 +1694,58 @@ def prepare_graph():
 			squeeze = False)
 	return fig, host
 
+# ======== Processing delay - sleep on the wall clock or advance the simulated clock
+def process_delay(delay, time_virtual, virtual_clock):
+	if virtual_clock:
+		return time_virtual + delay
+	time.sleep(delay)
+	return time_virtual
+
+# ======== Processing delays of the batch engine - drawn as arrays, they only advance the simulated clock. Zeros are packets without delay
+def process_delays(delay):
+	return delay
+
+# ======== Startup profile - time from the first import until the generation begins, against startup_budget
+def profile_startup(stages):
+	total = sum(duration for stage, duration in stages)
+	print("\nStartup profile")
+	for stage, duration in stages:
+		print("%s: %.1f ms" %(stage, duration * 1000))
+	print("Total: %.1f ms, %s the budget of %.0f ms" %(total * 1000, 'within' if total <= startup_budget else 'OVER', startup_budget * 1000))
+	print("Optional modules loaded: %s" %(', '.join(module for module in ['matplotlib', 'scapy'] if module in sys.modules) or 'none'))
+
+# ======== Random number generator of one stream - streams are spawned from the seed by their index, e.g. channel
+def rng_create(seed, *stream):
+	return np.random.default_rng(np.random.SeedSequence(seed, spawn_key = stream))
+
 # ======== Round up the input to the nearest base. Taken from: https://stackoverflow.com/questions/26454649/python-round-up-to-the-nearest-ten 
 def round_up(x, base):
 	return int(math.ceil(x / base)) * base
 
-# ======== Save all output files
-def save_output(datarate, fig, filename_extension, pkt_interarrival, pkt_length, pkt_list, title):
-	save_graph(fig, filename_extension, title)
-	save_packets(filename_extension, pkt_list)
-	save_statistics(datarate, filename_extension, pkt_interarrival, pkt_length)
+# ======== Save the output files of a channel - packets are saved once for all channels by save_packets
+def save_output(channel_statistics, fig, filename_extension, title):
+	if fig is not None: # no graph with --no-plot
+		save_graph(fig, filename_extension, title)
+	channel_statistics.close()
 
 # ======== Save generated packets to a pcap file
 def save_packets(filename_extension, pkt_list):
-	wrpcap(outputfolder + os.sep + date + filename_extension + '.' + outputfile_packets_extension, pkt_list)
+	if isinstance(pkt_list, UdpSender): # report the pacing, then save the packets it passed on
+		pkt_list.close()
+		pkt_list = pkt_list.sink
+	if isinstance(pkt_list, PcapStreamWriter): # packets are already streamed, write the rest of the buffer
+		pkt_list.close()
+		return
+	from scapy.utils import wrpcap
+	wrpcap(outputfolder + os.sep + date + filename_extension + '.' + outputfile_packets_extension, (pkt_scapy(pkt_list.flows, pkt) for pkt in pkt_list))
 
-# ======== Save statistical results to a csv file
-def save_statistics(datarate, filename_extension, pkt_interarrival, pkt_length):
-	with open(outputfolder + os.sep + date + filename_extension + '.' + outputfile_statistics_extension, 'w') as outputfile: 
-		outputfile.write("{}, {}, {}\n".format("Packet Inter-arrival (ms)", "Packet Length (bytes)", "Data Rate (kbps)"))
-		for x in zip(pkt_interarrival, pkt_length, datarate):
-			outputfile.write("{}, {}, {}\n".format(x[0], x[1], x[2]))
+# ======== Save statistical results to csv or npy files - a block of packets is written and added to the online statistics
+def save_statistics(channel_statistics, pkt_length, pkt_time):
+	channel_statistics.append(pkt_length, pkt_time)
 
 # ======== Save graph
 def save_graph(fig, filename_extension, title):
-	handles, labels = plt.gca().get_legend_handles_labels() # to avoid duplicate labels. Taken from: https://stackoverflow.com/questions/13588920/stop-matplotlib-repeating-labels-in-legend
+	handles, labels = fig.axes[-1].get_legend_handles_labels() # to avoid duplicate labels. Taken from: https://stackoverflow.com/questions/13588920/stop-matplotlib-repeating-labels-in-legend
 	by_label = dict(zip(labels, handles))
 	fig.legend(
 			by_label.values(),
@@ -334,22 +1760,153 @@ def save_graph(fig, filename_extension, title):
 
 # ======== Show graph
 def show_graph():
+	import matplotlib.pyplot as plt
 	plt.show()
 
-# ======== Statistics of the generated data - data rate, packet inter-arrival, packet length
-def statistics_results(datarate, firstrun, pkt, pkt_interarrival, pkt_length, pkt_length_total, pkt_list, time_previous):
-	time_difference = float(pkt.time - time_previous) * 1000 if time_previous != 0 else 0 # multiply by 1000 to convert into ms
-	pkt_interarrival.append(float(time_difference))
-	pkt_length.append(int(len(pkt)))
-	if int(time_previous) != int(pkt.time): 
-		if not firstrun: datarate.append(float(pkt_length_total * 8 / 1000)) # multiply by 8 to convert bytes to bits, divide by 1000 to convert into kbps
-		if pkt_length_total != 0: firstrun = False # to skip the first second 
-		pkt_length_total = 0
-	else:
-		datarate.append(float())
-	pkt_length_total += len(pkt)	
+# ======== Statistics of a whole trace with array operations - data rate per window and inter-arrival, as ChannelStatistics computes them block by block
+def statistics_batch(pkt_length, pkt_time, window):
+	pkt_interarrival = np.r_[0, np.diff(pkt_time) * 1000] # multiply by 1000 to convert into ms
+	return statistics_datarate(pkt_length, pkt_time, window)[1], pkt_interarrival
+
+# ======== Data rate per window of the clock - start (s) and data rate (kbps) of the complete windows, empty windows included
+def statistics_datarate(pkt_length, pkt_time, window):
+	pkt_time = np.asarray(pkt_time, dtype = np.float64)
+	if len(pkt_time) == 0:
+		return np.zeros(0), np.zeros(0)
+	window_index = np.floor(pkt_time / window).astype(np.int64)
+	window_bytes = np.bincount(window_index - window_index[0], weights = np.asarray(pkt_length, dtype = np.float64))[1:-1] # the first window starts before the first packet, the last one is not complete
+	window_start = (window_index[0] + 1 + np.arange(len(window_bytes))) * window
+	return window_start, window_bytes * 8 / 1000 / window # multiply by 8 to convert bytes to bits, divide by 1000 to convert into kbps
+
+# ======== Statistics of the generated data - packet length and time. Inter-arrival and data rate are computed per block by ChannelStatistics
+def statistics_results(pkt, pkt_length, pkt_list, pkt_time):
+	pkt_length.append(pkt.length)
+	pkt_time.append(pkt.time)
 	pkt_list.append(pkt) # list_pkt are the generated packets to be sent to the MAC layer for transmission
-	time_previous = pkt.time
-	return datarate, firstrun, pkt, pkt_interarrival, pkt_length, pkt_length_total, pkt_list, time_previous
+	return pkt_length, pkt_list, pkt_time
+
+# ======== Read a pcap trace in blocks - yields timestamps (s), IP lengths (bytes), protocols, source and destination addresses of the IPv4 packets
+def trace_blocks(trace_file):
+	header = trace_file.read(24)
+	if header[:4] in [b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1']:
+		endian = '<'
+	elif header[:4] in [b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d']:
+		endian = '>'
+	else:
+		raise ValueError("Not a pcap file. Only the classic pcap format is supported.")
+	resolution = 1e-9 if header[:4] in [b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d'] else 1e-6 # nanosecond or microsecond timestamps
+	linktype = struct.unpack(endian + 'I', header[20:24])[0] & 0xffff
+	if linktype not in trace_linktypes: # e.g. 802.11 captures, no IPv4 packets to read
+		return
+	offset_ip, offset_ethertype = trace_linktypes[linktype]
+	record = struct.Struct(endian + 'I')
+	rest = b''
+	while True:
+		block = trace_file.read(trace_block_size)
+		if not block:
+			return
+		data = rest + block # a record can span two blocks
+		offsets, offset = [], 0
+		while offset + 16 <= len(data): # walk the record headers, only the captured length is unpacked
+			end = offset + 16 + record.unpack_from(data, offset + 8)[0]
+			if end > len(data): 
+				break
+			offsets.append(offset)
+			offset = end
+		rest = data[offset:]
+		raw = np.frombuffer(data, dtype = np.uint8)
+		offsets = np.array(offsets, dtype = np.int64)
+		fields = raw[offsets[:, None] + np.arange(12)].view(endian + 'u4') # seconds, fraction, captured length per record
+		offsets = offsets + 16 + offset_ip
+		ipv4 = fields[:, 2] >= offset_ip + 20
+		if offset_ethertype is not None: 
+			ipv4[ipv4] = raw[offsets[ipv4] - offset_ip + offset_ethertype].astype(np.int64) * 256 + raw[offsets[ipv4] - offset_ip + offset_ethertype + 1] == 0x0800
+		ipv4[ipv4] = raw[offsets[ipv4]] >> 4 == 4
+		header_ip = raw[offsets[ipv4][:, None] + np.arange(20)] # only the IPv4 header fields are gathered, no packet is dissected
+		yield (fields[ipv4, 0] + fields[ipv4, 1] * resolution, 
+				header_ip[:, 2].astype(np.int64) * 256 + header_ip[:, 3], header_ip[:, 9], 
+				header_ip[:, 12:16].copy().view('>u4').ravel(), header_ip[:, 16:20].copy().view('>u4').ravel())
+
+# ======== Split a trace into channels - the UAV sends the most bytes, i.e. the video, and the ground station is its main peer
+def trace_channels(pkt_length, pkt_source, pkt_destination):
+	addresses, source = np.unique(pkt_source, return_inverse = True)
+	ip_uav = addresses[np.argmax(np.bincount(source, weights = pkt_length))]
+	peers, count = np.unique(pkt_destination[pkt_source == ip_uav], return_counts = True)
+	ip_ground = peers[np.argmax(count)] # remote control of the UAV
+	downlink = (pkt_source == ip_ground) & (pkt_destination == ip_uav)
+	uplink = (pkt_source == ip_uav) & (pkt_destination == ip_ground)
+	return ip_ground, ip_uav, downlink, uplink
+
+# ======== Pcap traces in a zip archive by device name
+def trace_members(filename):
+	with zipfile.ZipFile(filename) as archive:
+		return {os.path.splitext(os.path.basename(member))[0].replace(model_trace_suffix, ''): member 
+				for member in archive.namelist() if member.endswith('.' + outputfile_packets_extension)}
+
+# ======== Read the packets of one protocol from a pcap trace, memory-mapped or from a member of a zip archive - timestamps (s), IP lengths (bytes), source and destination addresses
+def trace_read(filename, member = None, protocol = 17):
+	if member is None:
+		with open(filename, 'rb') as trace_file, mmap.mmap(trace_file.fileno(), 0, access = mmap.ACCESS_READ) as trace_map:
+			blocks = list(trace_blocks(trace_map))
+	else:
+		with zipfile.ZipFile(filename) as archive, archive.open(member) as trace_file: # decompressed while it is read
+			blocks = list(trace_blocks(trace_file))
+	pkt_time, pkt_length, pkt_protocol, pkt_source, pkt_destination = (np.concatenate(column) for column in zip(*blocks)) if blocks else [np.zeros(0)] * 5
+	selected = pkt_protocol == protocol
+	return pkt_time[selected], pkt_length[selected], pkt_source[selected], pkt_destination[selected]
+
+# ======== Validation - autocorrelation of the values at lags 1..lags, computed with an FFT
+def validation_autocorrelation(values, lags):
+	values = values - values.mean()
+	spectrum = np.fft.rfft(values, 2 * len(values)) # zero padded, no circular wrap-around
+	autocovariance = np.fft.irfft(spectrum * np.conj(spectrum))[:lags + 1]
+	return autocovariance[1:] / autocovariance[0] if autocovariance[0] > 0 else np.zeros(lags)
+
+# ======== Validation - two-sample Kolmogorov-Smirnov distance, the largest gap between the CDF of the online statistics and the empirical CDF of the reference
+def validation_ks(statistics, reference):
+	if statistics.count == 0 or len(reference) == 0: 
+		return math.nan
+	reference = np.sort(reference)
+	points = np.concatenate([statistics.histogram()[0], reference])
+	return float(np.max(np.abs(statistics.cdf(points) - np.searchsorted(reference, points, side = 'right') / len(reference))))
+
+# ======== Validation - NaN metrics of a report as null, so that the json stays valid
+def validation_null(values):
+	if np.ndim(values) == 0:
+		return None if math.isnan(values) else float(values)
+	return [validation_null(value) for value in values]
+
+# ======== Validation - compare the statistics of each channel with the same channel of a real trace and save the report
+def validation_run(channels, device, filename_extension, statistics, window):
+	members = trace_members(model_archive)
+	pkt_time, pkt_length, pkt_source, pkt_destination = trace_read(model_archive, members[device])
+	ip_ground, ip_uav, downlink_trace, uplink_trace = trace_channels(pkt_length, pkt_source, pkt_destination)
+	report = {'device': device, 'trace': members[device], 'channels': {}}
+	for (downlink, channel_extension, channel_title), channel_statistics in zip(channels, statistics):
+		selected = downlink_trace if downlink else uplink_trace
+		datarate_trace, pkt_interarrival_trace = statistics_batch(pkt_length[selected], pkt_time[selected] - pkt_time[selected][0], window)
+		print("\nValidation of %s against %s (generated / real)" %(channel_title, device))
+		report['channels']['downlink' if downlink else 'uplink'] = metrics = {}
+		for label, generated, real in [
+				(label_x[1], channel_statistics.interarrival, pkt_interarrival_trace),
+				(label_x[2], channel_statistics.length, pkt_length[selected].astype(np.float64)),
+				(label_x[0], channel_statistics.datarate, datarate_trace)]:
+			quantiles = np.stack([generated.quantile(validation_quantiles), np.quantile(real, validation_quantiles) if len(real) else np.full(len(validation_quantiles), np.nan)], axis = 1)
+			ks, mean = validation_ks(generated, real), [generated.mean if generated.count else math.nan, real.mean() if len(real) else math.nan]
+			autocorrelation = [generated.autocorrelation(), validation_autocorrelation(real, validation_lags) if len(real) else np.full(validation_lags, np.nan)]
+			print("%s: KS %.4f, mean %.2f / %.2f, median %.2f / %.2f, 99th percentile %.2f / %.2f, lag-1 autocorrelation %.3f / %.3f" %(label, ks, 
+					*mean, *quantiles[validation_quantiles.index(0.5)], *quantiles[validation_quantiles.index(0.99)], autocorrelation[0][0], autocorrelation[1][0]))
+			metrics[label] = { # metrics without values, e.g. the data rate of a run shorter than two windows, are null
+					'ks': validation_null(ks),
+					'mean': validation_null(mean),
+					'quantiles': {str(quantile): validation_null(pair) for quantile, pair in zip(validation_quantiles, quantiles)},
+					'autocorrelation': [validation_null(lags) for lags in autocorrelation]}
+	with open(outputfolder + os.sep + date + filename_extension + '_validation.json', 'w') as report_file:
+		json.dump(report, report_file, indent = 1)
+
+# ======== Worker process initialization - progress is reported by the main process
+def worker_init():
+	sys.stdout = open(os.devnull, 'w')
 
-main()
\ No newline at end of file
+if __name__ == '__main__':
+	main()
\ No newline at end of file
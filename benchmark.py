@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+#####################################################
+# Benchmark of the traffic generator
+#
+# Measures the packets per second, the peak memory
+# and the time spent in each stage of aviator.py for
+# both channels, engines and several trace sizes.
+# Every case runs in its own process, so that its
+# peak memory is not shared with the other cases.
+#
+# Usage: python3 benchmark.py [--sizes N ...]
+#
+# License: GNU General Public License v3.0
+#
+#####################################################
+
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# ======== variables - modify them as you wish =========
+benchmark_channels = ['downlink', 'uplink']
+benchmark_engines = ['packet', 'batch'] # packet by packet on the simulated clock, or the vectorized engine
+benchmark_seed = 1
+benchmark_sizes = [1000, 10000, 100000, 1000000] # packets per case
+benchmark_groups = ['batch', 'io'] # stages of aviator.instrument_stages: vectorized generation, and the pcap and statistics writers
+benchmark_stages = ['layer_application', 'layer_transport', 'pkt_create', 'statistics_results', 'save_packets', 'save_statistics'] # functions of aviator.py timed per call, nested stages are included in their caller
+outputfolder = 'outputfiles'
+
+# ======== Run one case in this process and print its results as json
+def case_run(engine, channel, num_packets):
+	import numpy as np
+	import aviator
+	stages = {stage: [stage] for stage in benchmark_stages} # one stage per function
+	stages.update({stage: aviator.instrument_stages[stage] for stage in benchmark_groups}) # the packets are written while they are generated, not by save_packets
+	instrumentation = aviator.Instrumentation(stages)
+	argv = ['aviator.py', '-n', str(num_packets), '--seed', str(benchmark_seed), '--no-plot', '--virtual-clock']
+	argv += ['--batch'] if engine == 'batch' else []
+	argv += ['-u'] if channel == 'uplink' else []
+	with tempfile.TemporaryDirectory() as folder:
+		aviator.outputfolder = folder # output files of the case are discarded
+		sys.argv, sys.stdout = argv, open(os.devnull, 'w')
+		start = time.perf_counter()
+		aviator.main()
+		seconds = time.perf_counter() - start
+		sys.stdout.close()
+		sys.stdout = sys.__stdout__
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KB on Linux, bytes on macOS
+	print(json.dumps({
+			'engine': engine,
+			'channel': channel,
+			'packets': num_packets,
+			'seconds': seconds,
+			'packets_per_second': num_packets / seconds,
+			'peak_rss_kb': rss // 1024 if sys.platform == 'darwin' else rss,
+			'sleeps': instrumentation.sleeps,
+			'stages': {stage: {'calls': instrumentation.calls[stage], 'seconds': instrumentation.seconds[stage]} for stage in stages},
+			'numpy': np.__version__}))
+
+# ======== Run every case in a child process and collect the results
+def main():
+	args = parse_args()
+	results = []
+	for num_packets in args.sizes:
+		for engine in args.engines:
+			for channel in args.channels:
+				completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', engine, channel, str(num_packets)],
+						capture_output = True, cwd = os.path.dirname(os.path.abspath(__file__)), text = True)
+				if completed.returncode:
+					print(completed.stderr)
+					sys.exit(completed.returncode)
+				result = json.loads(completed.stdout.splitlines()[-1])
+				results.append(result)
+				print("%-6s %-8s %8d packets: %10.0f packets/s, %8.2f s, peak RSS %7d KB"
+						%(engine, channel, num_packets, result['packets_per_second'], result['seconds'], result['peak_rss_kb']))
+				for stage, timing in result['stages'].items():
+					if timing['calls']:
+						print("    %-20s %9d calls %8.3f s" %(stage, timing['calls'], timing['seconds']))
+	report = {
+			'date': datetime.now().isoformat(timespec = 'seconds'),
+			'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(), 'python': platform.python_version(),
+					'numpy': results[0]['numpy'] if results else None},
+			'results': [{key: value for key, value in result.items() if key != 'numpy'} for result in results]}
+	with open(args.output, 'w') as report_file:
+		json.dump(report, report_file, indent = 1)
+	print("Saved %s" %args.output)
+
+# ======== Parse arguments
+def parse_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--case',
+						nargs = 3,
+						help = argparse.SUPPRESS, # ENGINE CHANNEL N, used by the child processes
+						default = None,
+						required = False)
+
+	parser.add_argument('--channels',
+						nargs = '+',
+						choices = benchmark_channels,
+						help = "Channels to benchmark. Both are default.",
+						default = benchmark_channels,
+						required = False)
+
+	parser.add_argument('--engines',
+						nargs = '+',
+						choices = benchmark_engines,
+						help = "Engines to benchmark: packet by packet on the simulated clock and the vectorized batch engine. Both are default.",
+						default = benchmark_engines,
+						required = False)
+
+	parser.add_argument('--output',
+						action = "store",
+						help = "JSON report of all cases. outputfiles/<date>_benchmark.json is default.",
+						default = outputfolder + os.sep + datetime.now().strftime('%Y%m%d_%H%M%S') + '_benchmark.json',
+						required = False)
+
+	parser.add_argument('--sizes',
+						nargs = '+',
+						type = int,
+						help = "Number of packets of each case. 1000 10000 100000 1000000 is default.",
+						default = benchmark_sizes,
+						required = False)
+
+	args = parser.parse_args()
+	if args.case:
+		engine, channel, num_packets = args.case
+		case_run(engine, channel, int(num_packets))
+		sys.exit(0)
+	if any(num_packets < 1 for num_packets in args.sizes):
+		print("Your input for --sizes is not valid.\nPlease provide positive integers.")
+		sys.exit(0)
+	return args
+
+if __name__ == '__main__':
+	main()